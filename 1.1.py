@@ -1,7 +1,14 @@
+import argparse
 import psycopg2
 import time
-import re
+import json
+import statistics
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Mapping, Optional
+from psycopg2.pool import ThreadedConnectionPool
 
 # --- Конфигурация подключения к БД ---
 DB_CONFIG = {
@@ -12,51 +19,126 @@ DB_CONFIG = {
     "port": "5433"
 }
 
-# --- Запросы для тестирования ---
-QUERIES = {
-    "exact_match_postal": {
-        "description": "Точный поиск по почтовому индексу",
-        "query": "SELECT COUNT(*) FROM mutations_foncieres WHERE code_postal = '75015';",
-        "index_type": "B-Tree",
-        "index_column": "code_postal",
-        "index_sql": "CREATE INDEX idx_btree_code_postal ON mutations_foncieres USING btree (code_postal);",
-        "cleanup_sql": "DROP INDEX IF EXISTS idx_btree_code_postal;"
-    },
-    "range_scan_value": {
-        "description": "Поиск по диапазону стоимости",
-        "query": "SELECT COUNT(*) FROM mutations_foncieres WHERE valeur_fonciere BETWEEN 100000 AND 150000;",
-        "index_type": "B-Tree",
-        "index_column": "valeur_fonciere",
-        "index_sql": "CREATE INDEX idx_btree_valeur_fonciere ON mutations_foncieres USING btree (valeur_fonciere);",
-        "cleanup_sql": "DROP INDEX IF EXISTS idx_btree_valeur_fonciere;"
-    },
-    "range_scan_date": {
-        "description": "Поиск по диапазону дат (для B-Tree)",
-        "query": "SELECT COUNT(*) FROM mutations_foncieres WHERE date_mutation BETWEEN '2019-01-01' AND '2019-01-31';",
-        "index_type": "B-Tree",
-        "index_column": "date_mutation",
-        "index_sql": "CREATE INDEX idx_btree_date_mutation ON mutations_foncieres USING btree (date_mutation);",
-        "cleanup_sql": "DROP INDEX IF EXISTS idx_btree_date_mutation;"
-    },
-     "text_search_like": {
-        "description": "Поиск по подстроке в названии улицы (LIKE '%...%')",
-        "query": "SELECT COUNT(*) FROM mutations_foncieres WHERE adresse_nom_voie LIKE '%AVENUE%';",
-        "index_type": "GIN (pg_trgm)",
-        "index_column": "adresse_nom_voie",
-        "extension_sql": "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
-        "index_sql": "CREATE INDEX idx_gin_trgm_adresse_nom_voie ON mutations_foncieres USING gin (adresse_nom_voie gin_trgm_ops);",
-        "cleanup_sql": "DROP INDEX IF EXISTS idx_gin_trgm_adresse_nom_voie;"
-    },
-    "range_scan_date_brin": {
-        "description": "Поиск по широкому диапазону дат (для BRIN)",
-        "query": "SELECT COUNT(*) FROM mutations_foncieres WHERE date_mutation BETWEEN '2017-01-01' AND '2017-12-31';",
-        "index_type": "BRIN",
-        "index_column": "date_mutation",
-        "index_sql": "CREATE INDEX idx_brin_date_mutation ON mutations_foncieres USING brin (date_mutation);",
-        "cleanup_sql": "DROP INDEX IF EXISTS idx_brin_date_mutation;"
-    }
+# Директория для планов EXPLAIN (пишутся сразу после замера, в памяти хранится только путь)
+PLANS_DIR = Path("./plans")
+
+# Количество повторных замеров (после одного прогревочного), по ним берется медиана
+REPEATS = 5
+
+# Количество параллельных потоков для тестов. Тесты по одной колонке всегда идут в одном потоке
+# (иначе индекс одного теста исказит baseline другого). Параллельная нагрузка добавляет шум
+# в замеры; для максимально чистых чисел значение можно уменьшить до 1.
+PARALLEL_WORKERS = 2
+
+# Параметры сессии для построения индексов (сортировка в памяти + параллельные воркеры)
+INDEX_BUILD_SETTINGS = {
+    "maintenance_work_mem": "1GB",
+    "max_parallel_maintenance_workers": "4",
 }
 
+# Варианты pages_per_range для BRIN-индекса (128 - значение по умолчанию)
+BRIN_PAGES_PER_RANGE = (32, 128, 512)
+
+# --- Запросы для тестирования ---
+@dataclass(frozen=True, slots=True)
+class IndexTest:
+    """Описание одного теста: запрос, индекс под него и SQL для его создания/удаления."""
+    name: str
+    description: str
+    query: str
+    index_type: str
+    index_column: str
+    index_sql: str
+    cleanup_sql: str
+    extension_sql: Optional[str] = None
+    # Параметры сессии, переопределяющие INDEX_BUILD_SETTINGS на время построения индекса
+    build_settings: Mapping[str, str] = field(default_factory=dict)
+    # ANALYZE после создания индекса (нужно только для индексов по выражениям)
+    needs_analyze: bool = False
+    # Параметр pages_per_range (только для BRIN)
+    pages_per_range: Optional[int] = None
+
+    @property
+    def index_name(self):
+        """Имя индекса из index_sql (слово перед ON)."""
+        tokens = self.index_sql.split()
+        return tokens[tokens.index("ON") - 1]
+
+    @property
+    def statement_name(self):
+        """Имя подготовленного (PREPARE) запроса теста."""
+        return f"m_{self.name}"
+
+
+TESTS = (
+    IndexTest(
+        name="exact_match_postal",
+        description="Точный поиск по почтовому индексу",
+        query="SELECT COUNT(*) FROM mutations_foncieres WHERE code_postal = '75015';",
+        index_type="B-Tree",
+        index_column="code_postal",
+        index_sql="CREATE INDEX CONCURRENTLY idx_btree_code_postal ON mutations_foncieres USING btree (code_postal);",
+        cleanup_sql="DROP INDEX CONCURRENTLY IF EXISTS idx_btree_code_postal;",
+    ),
+    # Hash-индекс для того же точного поиска: хранит только 4-байтовый хеш ключа,
+    # сравнение с B-Tree по времени и размеру на диске
+    IndexTest(
+        name="exact_match_postal_hash",
+        description="Точный поиск по почтовому индексу (Hash)",
+        query="SELECT COUNT(*) FROM mutations_foncieres WHERE code_postal = '75015';",
+        index_type="Hash",
+        index_column="code_postal",
+        index_sql="CREATE INDEX CONCURRENTLY idx_hash_code_postal ON mutations_foncieres USING hash (code_postal);",
+        cleanup_sql="DROP INDEX CONCURRENTLY IF EXISTS idx_hash_code_postal;",
+    ),
+    IndexTest(
+        name="range_scan_value",
+        description="Поиск по диапазону стоимости",
+        query="SELECT COUNT(*) FROM mutations_foncieres WHERE valeur_fonciere BETWEEN 100000 AND 150000;",
+        index_type="B-Tree",
+        index_column="valeur_fonciere",
+        index_sql="CREATE INDEX CONCURRENTLY idx_btree_valeur_fonciere ON mutations_foncieres USING btree (valeur_fonciere);",
+        cleanup_sql="DROP INDEX CONCURRENTLY IF EXISTS idx_btree_valeur_fonciere;",
+    ),
+    IndexTest(
+        name="range_scan_date",
+        description="Поиск по диапазону дат (для B-Tree)",
+        query="SELECT COUNT(*) FROM mutations_foncieres WHERE date_mutation BETWEEN '2019-01-01' AND '2019-01-31';",
+        index_type="B-Tree",
+        index_column="date_mutation",
+        index_sql="CREATE INDEX CONCURRENTLY idx_btree_date_mutation ON mutations_foncieres USING btree (date_mutation);",
+        cleanup_sql="DROP INDEX CONCURRENTLY IF EXISTS idx_btree_date_mutation;",
+    ),
+    IndexTest(
+        name="text_search_like",
+        description="Поиск по подстроке в названии улицы (LIKE '%...%')",
+        query="SELECT COUNT(*) FROM mutations_foncieres WHERE adresse_nom_voie LIKE '%AVENUE%';",
+        index_type="GIN (pg_trgm)",
+        index_column="adresse_nom_voie",
+        extension_sql="CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+        # fastupdate = off: индекс строится разово под чтение, pending list не нужен
+        index_sql="CREATE INDEX CONCURRENTLY idx_gin_trgm_adresse_nom_voie ON mutations_foncieres USING gin (adresse_nom_voie gin_trgm_ops) WITH (fastupdate = off);",
+        build_settings={"maintenance_work_mem": "2GB"},
+        cleanup_sql="DROP INDEX CONCURRENTLY IF EXISTS idx_gin_trgm_adresse_nom_voie;",
+    ),
+    # BRIN с разной гранулярностью диапазонов: меньше pages_per_range - точнее min/max,
+    # меньше лишних страниц кучи, но больше сам индекс
+    *(
+        IndexTest(
+            name=f"range_scan_date_brin_{pages}",
+            description=f"Поиск по широкому диапазону дат (для BRIN, pages_per_range={pages})",
+            query="SELECT COUNT(*) FROM mutations_foncieres WHERE date_mutation BETWEEN '2017-01-01' AND '2017-12-31';",
+            index_type="BRIN",
+            index_column="date_mutation",
+            index_sql=f"CREATE INDEX CONCURRENTLY idx_brin_date_mutation_{pages} ON mutations_foncieres USING brin (date_mutation) WITH (pages_per_range = {pages});",
+            cleanup_sql=f"DROP INDEX CONCURRENTLY IF EXISTS idx_brin_date_mutation_{pages};",
+            pages_per_range=pages,
+        )
+        for pages in BRIN_PAGES_PER_RANGE
+    ),
+)
+TESTS_BY_NAME = {test.name: test for test in TESTS}
+
 @contextmanager
 def db_connection():
     """Контекстный менеджер для управления соединением с БД."""
@@ -76,104 +158,272 @@ def db_connection():
             conn.close()
             print("Соединение закрыто.")
 
-def execute_query(conn, sql, analyze=False):
-    """Выполняет SQL-запрос и возвращает результат или время выполнения."""
-    cur = conn.cursor()
-    query_to_run = f"EXPLAIN ANALYZE {sql}" if analyze else sql
-    start_time = time.time()
+def execute_query(cur, sql, analyze=False):
+    """
+    Выполняет SQL-запрос на общем курсоре и возвращает время выполнения и (для analyze) план в виде JSON.
+    Соединение работает в autocommit, поэтому DDL не требует отдельных commit()
+    (а CREATE/DROP INDEX CONCURRENTLY внутри транзакции выполнить нельзя).
+    """
+    query_to_run = f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}" if analyze else sql
+    start_ns = time.perf_counter_ns()
     try:
         cur.execute(query_to_run)
         result = cur.fetchall() if analyze else None
-        end_time = time.time()
-        execution_time_ms = (end_time - start_time) * 1000
+        execution_time_ms = (time.perf_counter_ns() - start_ns) / 1e6
 
         if analyze:
-            explain_output = "\n".join([row[0] for row in result])
-            match = re.search(r"Execution Time: ([\d\.]+) ms", explain_output)
-            if match:
-                return float(match.group(1)), explain_output
+            # psycopg2 сам декодирует json-колонку EXPLAIN в list/dict
+            plan_json = result[0][0]
+            if isinstance(plan_json, str):
+                plan_json = json.loads(plan_json)
+            plan = plan_json[0]
+            if "Execution Time" in plan:
+                return plan["Execution Time"], plan
             else:
-                print("Предупреждение: Не удалось извлечь 'Execution Time' из EXPLAIN ANALYZE. Используется общее время.")
-                return execution_time_ms, explain_output
+                print("Предупреждение: В плане EXPLAIN нет 'Execution Time'. Используется общее время.")
+                return execution_time_ms, plan
         else:
             return execution_time_ms, None
 
     except psycopg2.Error as e:
         print(f"Ошибка выполнения запроса:\n{sql}\nОшибка: {e}")
-        conn.rollback()
         return None, None
-    finally:
-        cur.close()
 
+def find_scan_node_type(plan):
+    """Ищет в JSON-плане первый узел, читающий таблицу, и возвращает его тип (Seq Scan, Index Scan, ...)."""
+    if plan is None:
+        return None
+    nodes = [plan["Plan"]] if "Plan" in plan else [plan]
+    while nodes:
+        node = nodes.pop(0)
+        if "Relation Name" in node:
+            return node["Node Type"]
+        nodes.extend(node.get("Plans", []))
+    return None
+
+def get_buffer_pages(plan):
+    """
+    Возвращает (число прочитанных страниц, доля попаданий в кэш) по счетчикам BUFFERS.
+    Счетчики узла включают дочерние узлы, поэтому берутся с корневого узла плана.
+    """
+    if plan is None or "Plan" not in plan:
+        return None, None
+    hit = plan["Plan"].get("Shared Hit Blocks", 0)
+    read = plan["Plan"].get("Shared Read Blocks", 0)
+    total = hit + read
+    return total, (hit / total if total else None)
+
+def format_percent(value):
+    """Форматирует долю как процент."""
+    return f"{value:.1%}" if isinstance(value, (int, float)) else "N/A"
+
+def format_value(value):
+    """Форматирует число для итоговой таблицы ('N/A' для отсутствующих значений)."""
+    return f"{value:.2f}" if isinstance(value, (int, float)) else "N/A"
+
+def format_speedup(value):
+    """Форматирует ускорение для итоговой таблицы."""
+    return f"{value:.2f}x" if isinstance(value, (int, float)) else "N/A"
+
+def save_plan(test_name, kind, plan):
+    """Сохраняет JSON-план в файл PLANS_DIR/<test>_<kind>.json и возвращает путь к нему."""
+    plan_path = PLANS_DIR / f"{test_name}_{kind}.json"
+    try:
+        PLANS_DIR.mkdir(parents=True, exist_ok=True)
+        plan_path.write_text(json.dumps(plan, indent=2, ensure_ascii=False), encoding="utf-8")
+    except OSError as e:
+        print(f"Не удалось сохранить план {plan_path}: {e}")
+        return None
+    return plan_path
+
+def format_plan(plan_path):
+    """Читает сохраненный план (только для итогового вывода)."""
+    if plan_path is None:
+        return 'Нет данных'
+    try:
+        return plan_path.read_text(encoding="utf-8")
+    except OSError as e:
+        return f"Не удалось прочитать план {plan_path}: {e}"
+
+def timed_query(cur, sql, repeats=None):
+    """
+    Прогревает кэш одним запуском EXPLAIN ANALYZE, затем выполняет его repeats раз (по умолчанию REPEATS).
+    Возвращает медиану Execution Time и план последнего запуска.
+    """
+    if repeats is None:
+        repeats = REPEATS
+    warmup_time, _ = execute_query(cur, sql, analyze=True)
+    if warmup_time is None:
+        return None, None
+
+    times = []
+    plan = None
+    for _ in range(repeats):
+        exec_time, plan = execute_query(cur, sql, analyze=True)
+        if exec_time is None:
+            return None, None
+        times.append(exec_time)
+    return statistics.median(times), plan
+
+def prewarm_table(cur, table_name="mutations_foncieres"):
+    """Загружает таблицу в shared buffers через pg_prewarm (если расширение доступно)."""
+    prewarm_time, _ = execute_query(cur, f"SELECT pg_prewarm('{table_name}');")
+    if prewarm_time is not None:
+        print(f"Таблица {table_name} загружена в кэш за {prewarm_time:.2f} ms")
+    else:
+        print("Предупреждение: pg_prewarm недоступен, замеры начнутся с холодного кэша.")
+
+def prepare_session(cur):
+    """
+    Устанавливает все нужные расширения и параметры построения индексов за один round-trip.
+    Если пакет не выполнился целиком, повторяет команды по одной.
+    """
+    statements = ["CREATE EXTENSION IF NOT EXISTS pg_prewarm;"]
+    for test in TESTS:
+        if test.extension_sql and test.extension_sql not in statements:
+            statements.append(test.extension_sql)
+    statements += [f"SET {setting} = '{value}';" for setting, value in INDEX_BUILD_SETTINGS.items()]
+
+    print("Установка расширений и параметров сессии...")
+    batch_time, _ = execute_query(cur, "\n".join(statements))
+    if batch_time is None:
+        print("Пакетная установка не удалась, выполнение команд по одной...")
+        for statement in statements:
+            execute_query(cur, statement)
+    print("Параметры построения индексов: " + ", ".join(f"{k}={v}" for k, v in INDEX_BUILD_SETTINGS.items()))
 
-def run_index_test(conn, test_name, config):
-    """Запускает тест для конкретного запроса и индекса."""
-    print(f"\n--- Тест: {test_name} ({config['description']}) ---")
-    print(f"Целевая колонка: {config['index_column']}, Тип индекса: {config['index_type']}")
+def prepare_test_query(cur, test):
+    """
+    Подготавливает запрос теста (PREPARE), чтобы повторные замеры не тратили время на разбор SQL.
+    Возвращает SQL для замера: EXECUTE подготовленного запроса или исходный запрос при ошибке.
+    """
+    prepare_time, _ = execute_query(cur, f"PREPARE {test.statement_name} AS {test.query.rstrip(';')};")
+    if prepare_time is None:
+        print("Предупреждение: Не удалось подготовить запрос, замеры будут на исходном SQL.")
+        return test.query
+    return f"EXECUTE {test.statement_name};"
+
+def release_test_query(cur, test, query):
+    """Удаляет подготовленный запрос теста (если PREPARE был успешен)."""
+    if query != test.query:
+        execute_query(cur, f"DEALLOCATE {test.statement_name};")
+
+def fetch_existing_indexes(cur):
+    """
+    Возвращает множество имен индексов, уже существующих на mutations_foncieres.
+    При ошибке считает, что существуют все индексы тестов (предварительная очистка не пропускается).
+    """
+    try:
+        cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'mutations_foncieres';")
+        return {row[0] for row in cur.fetchall()}
+    except psycopg2.Error as e:
+        print(f"Не удалось получить список индексов: {e}")
+        return {test.index_name for test in TESTS}
+
+def get_index_size_mb(cur, index_name):
+    """Возвращает размер индекса на диске в MB (None при ошибке)."""
+    try:
+        cur.execute("SELECT pg_relation_size(%s::regclass);", (index_name,))
+        return cur.fetchone()[0] / (1024 * 1024)
+    except psycopg2.Error as e:
+        print(f"Не удалось получить размер индекса {index_name}: {e}")
+        return None
+
+def run_index_test(cur, test, existing_indexes):
+    """
+    Запускает тест для конкретного запроса и индекса.
+    existing_indexes - множество существующих индексов, обновляется по ходу теста.
+    """
+    print(f"\n--- Тест: {test.name} ({test.description}) ---")
+    print(f"Целевая колонка: {test.index_column}, Тип индекса: {test.index_type}")
 
-    query = config['query']
     results = {}
 
-    # 0. Очистка перед тестом (на всякий случай)
-    if "cleanup_sql" in config:
+    # 0. Очистка перед тестом (только если индекс остался от прошлого запуска)
+    if test.index_name in existing_indexes:
         print("Предварительная очистка индекса...")
-        execute_query(conn, config['cleanup_sql'])
-        conn.commit()
+        execute_query(cur, test.cleanup_sql)
+        existing_indexes.discard(test.index_name)
 
-    # 1. Установка расширений (если необходимо)
-    if "extension_sql" in config:
-        print("Установка необходимого расширения...")
-        _, _ = execute_query(conn, config['extension_sql'])
-        conn.commit()
+    # План подготовленного запроса инвалидируется при создании индекса, поэтому его можно переиспользовать
+    query = prepare_test_query(cur, test)
 
-    # 2. Измерение БЕЗ индекса
-    print("Измерение производительности БЕЗ индекса...")
-    baseline_time, baseline_plan = execute_query(conn, query, analyze=True)
+    # 1. Измерение БЕЗ индекса
+    print(f"Измерение производительности БЕЗ индекса (прогрев + медиана из {REPEATS})...")
+    baseline_time, baseline_plan = timed_query(cur, query)
     if baseline_time is not None:
-        print(f"Время БЕЗ индекса: {baseline_time:.2f} ms")
+        print(f"Время БЕЗ индекса (медиана): {baseline_time:.2f} ms")
         results["baseline_ms"] = baseline_time
-        results["baseline_plan"] = baseline_plan
+        results["baseline_pages"], baseline_hit_ratio = get_buffer_pages(baseline_plan)
+        print(f"Страниц БЕЗ индекса: {results['baseline_pages']} (из кэша: {format_percent(baseline_hit_ratio)})")
+        results["baseline_plan"] = save_plan(test.name, "baseline", baseline_plan)
     else:
         print("Не удалось измерить baseline.")
-        return test_name, None
+        release_test_query(cur, test, query)
+        return test.name, None
 
-    # 3. Создание индекса
-    if "index_sql" in config:
-        print(f"Создание индекса ({config['index_type']} на {config['index_column']})...")
-        index_creation_time, _ = execute_query(conn, config['index_sql'])
-        conn.commit()
+    # 2. Создание индекса
+    if test.index_sql:
+        print(f"Создание индекса ({test.index_type} на {test.index_column})...")
+        build_settings = test.build_settings
+        for setting, value in build_settings.items():
+            execute_query(cur, f"SET {setting} = '{value}';")
+        index_creation_time, _ = execute_query(cur, test.index_sql)
+        # Возвращаем общие параметры построения для следующих тестов
+        for setting in build_settings:
+            if setting in INDEX_BUILD_SETTINGS:
+                execute_query(cur, f"SET {setting} = '{INDEX_BUILD_SETTINGS[setting]}';")
+            else:
+                execute_query(cur, f"RESET {setting};")
         if index_creation_time is not None:
             print(f"Индекс создан за {index_creation_time:.2f} ms")
+            existing_indexes.add(test.index_name)
+            results["index_size_mb"] = get_index_size_mb(cur, test.index_name)
+            if results["index_size_mb"] is not None:
+                print(f"Размер индекса: {results['index_size_mb']:.2f} MB")
             results["index_creation_ms"] = index_creation_time
 
-            print("Выполнение ANALYZE для обновления статистики таблицы...")
-            analyze_time, _ = execute_query(conn, f"ANALYZE mutations_foncieres;")
-            conn.commit()
-            print(f"ANALYZE выполнен за {analyze_time:.2f} ms")
+            # Индекс по обычной колонке не меняет статистику таблицы,
+            # ANALYZE нужен только для индексов по выражениям
+            if test.needs_analyze:
+                print("Выполнение ANALYZE для обновления статистики таблицы...")
+                analyze_time, _ = execute_query(cur, f"ANALYZE mutations_foncieres;")
+                print(f"ANALYZE выполнен за {analyze_time:.2f} ms")
 
         else:
             print("Ошибка создания индекса.")
-            if "cleanup_sql" in config:
-                execute_query(conn, config['cleanup_sql'])
-                conn.commit()
-            return test_name, results
-
-    # 4. Измерение С индексом
-    print("Измерение производительности С индексом...")
-    indexed_time, indexed_plan = execute_query(conn, query, analyze=True)
+            execute_query(cur, test.cleanup_sql)
+            release_test_query(cur, test, query)
+            return test.name, results
+
+    # 3. Измерение С индексом
+    # enable_seqscan = off действует только внутри этой транзакции и не дает планировщику
+    # молча выбрать Seq Scan, из-за чего "ускорение" измеряло бы шум, а не индекс
+    print(f"Измерение производительности С индексом (прогрев + медиана из {REPEATS}, enable_seqscan = off)...")
+    execute_query(cur, "BEGIN; SET LOCAL enable_seqscan = off;")
+    try:
+        indexed_time, indexed_plan = timed_query(cur, query)
+    finally:
+        execute_query(cur, "COMMIT;")
     if indexed_time is not None:
-        print(f"Время С индексом: {indexed_time:.2f} ms")
+        print(f"Время С индексом (медиана): {indexed_time:.2f} ms")
         results["indexed_ms"] = indexed_time
-        results["indexed_plan"] = indexed_plan
+        results["indexed_node"] = find_scan_node_type(indexed_plan)
+        print(f"Узел сканирования таблицы: {results['indexed_node']}")
+        if results["indexed_node"] == "Seq Scan":
+            print("Предупреждение: Даже с enable_seqscan = off используется Seq Scan, индекс не применяется!")
+        results["indexed_pages"], indexed_hit_ratio = get_buffer_pages(indexed_plan)
+        print(f"Страниц С индексом: {results['indexed_pages']} (из кэша: {format_percent(indexed_hit_ratio)})")
+        results["indexed_plan"] = save_plan(test.name, "indexed", indexed_plan)
     else:
         print("Не удалось измерить время с индексом.")
 
-    # 5. Очистка индекса
-    if "cleanup_sql" in config:
-        print("Очистка индекса после теста...")
-        cleanup_time, _ = execute_query(conn, config['cleanup_sql'])
-        conn.commit()
-        print(f"Индекс удален за {cleanup_time:.2f} ms")
+    # 4. Очистка индекса и подготовленного запроса
+    print("Очистка индекса после теста...")
+    cleanup_time, _ = execute_query(cur, test.cleanup_sql)
+    existing_indexes.discard(test.index_name)
+    print(f"Индекс удален за {cleanup_time:.2f} ms")
+    release_test_query(cur, test, query)
 
     # Расчет ускорения
     if "baseline_ms" in results and "indexed_ms" in results:
@@ -183,13 +433,62 @@ def run_index_test(conn, test_name, config):
     else:
         results["speedup"] = "N/A"
 
-    return test_name, results
+    return test.name, results
+
+def group_tests_by_column(tests):
+    """Группирует тесты по целевой колонке: тесты одной группы нельзя выполнять параллельно."""
+    groups = {}
+    for test in tests:
+        groups.setdefault(test.index_column, []).append(test)
+    return list(groups.values())
+
+def run_test_group(pool, tests, existing_indexes):
+    """Выполняет группу тестов последовательно на отдельном соединении из пула."""
+    conn = pool.getconn()
+    group_results = {}
+    try:
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            # Соединение из пула могло остаться от другой группы: сбрасываем состояние сессии
+            # (SET, подготовленные запросы, временные таблицы) перед замерами
+            cur.execute("DISCARD ALL;")
+            # Параметры SET действуют на уровне сессии, поэтому задаются для каждого соединения
+            prepare_session(cur)
+            for test in tests:
+                test_name, result_data = run_index_test(cur, test, existing_indexes)
+                group_results[test_name] = result_data
+        finally:
+            cur.close()
+    finally:
+        pool.putconn(conn)
+    return group_results
+
+def parse_args():
+    """Разбирает аргументы командной строки (выбор тестов и число повторов)."""
+    parser = argparse.ArgumentParser(description="Сравнение производительности запросов с индексами и без.")
+    parser.add_argument("--tests", default="",
+                        help="Список тестов через запятую (по умолчанию все): " + ", ".join(TESTS_BY_NAME))
+    parser.add_argument("--repeats", type=int, default=REPEATS,
+                        help=f"Число замеров после прогрева, по ним берется медиана (по умолчанию {REPEATS})")
+    args = parser.parse_args()
+    selected = {name.strip() for name in args.tests.split(",") if name.strip()} or set(TESTS_BY_NAME)
+    unknown = selected - set(TESTS_BY_NAME)
+    if unknown:
+        parser.error(f"Неизвестные тесты: {', '.join(sorted(unknown))}")
+    if args.repeats < 1:
+        parser.error("--repeats должно быть >= 1")
+    return selected, args.repeats
 
 # --- Основной блок выполнения ---
 if __name__ == "__main__":
+    selected_tests, REPEATS = parse_args()
     all_results = {}
     with db_connection() as connection:
         if connection:
+            # Все операции (DDL и замеры) независимы, транзакции между ними не нужны
+            connection.autocommit = True
+            # Курсор для проверки таблицы, установки расширений и прогрева кэша
             cur = connection.cursor()
             try:
                 cur.execute("SELECT COUNT(*) FROM mutations_foncieres;")
@@ -199,37 +498,63 @@ if __name__ == "__main__":
                     print("Предупреждение: Количество строк кажется малым для демонстрации BRIN/GIN. Убедитесь, что данные загружены.")
             except psycopg2.Error as e:
                 print(f"Ошибка проверки таблицы: {e}")
+                cur.close()
                 exit()
+
+            try:
+                prepare_session(cur)
+                # Прогрев кэша, чтобы baseline не измерял чтение с диска
+                prewarm_table(cur)
+                # Индексы, оставшиеся от прошлых запусков (для пропуска лишних DROP)
+                existing_indexes = fetch_existing_indexes(cur)
             finally:
                 cur.close()
 
-            # Запуск тестов
-            for name, test_config in QUERIES.items():
-                test_name, result_data = run_index_test(connection, name, test_config)
-                all_results[test_name] = result_data
+    # Запуск тестов: каждая группа получает свое соединение из пула
+    test_groups = group_tests_by_column(test for test in TESTS if test.name in selected_tests)
+    workers = max(1, min(PARALLEL_WORKERS, len(test_groups)))
+    pool = ThreadedConnectionPool(minconn=1, maxconn=workers, **DB_CONFIG)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_test_group, pool, tests, existing_indexes) for tests in test_groups]
+            finished = {}
+            for future in futures:
+                finished.update(future.result())
+    finally:
+        pool.closeall()
+    # Сохраняем порядок тестов из TESTS
+    all_results = {test.name: finished[test.name] for test in TESTS if test.name in finished}
 
     # --- Вывод итоговых результатов ---
     print("\n\n--- Итоговые результаты ---")
-    print("-" * 80)
-    print(f"{'Тест':<25} | {'Тип индекса':<15} | {'Колонка':<20} | {'Baseline (ms)':<15} | {'Indexed (ms)':<15} | {'Ускорение':<10}")
-    print("-" * 80)
-
+    row_template = "{:<25} | {:<15} | {:<20} | {:<11} | {:<15} | {:<15} | {:<10} | {:<11} | {:<20}"
+    header = row_template.format('Тест', 'Тип индекса', 'Колонка', 'Pages/range', 'Baseline (ms)', 'Indexed (ms)',
+                                 'Ускорение', 'Размер (MB)', 'Pages (base→idx)')
+    rows = []
     for name, results in all_results.items():
+        test = TESTS_BY_NAME[name]
+        pages_per_range = test.pages_per_range if test.pages_per_range is not None else '-'
         if results:
-             print(f"{name:<25} | {QUERIES[name]['index_type']:<15} | {QUERIES[name]['index_column']:<20} | "
-                   f"{results.get('baseline_ms', 'N/A'):<15.2f} | {results.get('indexed_ms', 'N/A'):<15.2f} | "
-                   f"{results.get('speedup', 'N/A'):<10.2f}x")
+            rows.append((name, test.index_type, test.index_column, pages_per_range,
+                         format_value(results.get('baseline_ms')), format_value(results.get('indexed_ms')),
+                         format_speedup(results.get('speedup')), format_value(results.get('index_size_mb')),
+                         f"{results.get('baseline_pages', 'N/A')}→{results.get('indexed_pages', 'N/A')}"))
         else:
-            print(f"{name:<25} | {QUERIES[name]['index_type']:<15} | {QUERIES[name]['index_column']:<20} | {'FAIL':<15} | {'FAIL':<15} | {'N/A':<10}")
+            rows.append((name, test.index_type, test.index_column, pages_per_range, 'FAIL', 'FAIL', 'N/A', 'N/A', 'N/A'))
 
-    print("-" * 80)
+    separator = "-" * len(header)
+    print(separator)
+    print(header)
+    print(separator)
+    print("\n".join(row_template.format(*row) for row in rows))
+    print(separator)
 
     # Вывод планов выполнения для детального анализа
     for name, results in all_results.items():
         if results:
             print(f"\n--- Планы выполнения для теста: {name} ---")
             print("--- Baseline Plan ---")
-            print(results.get('baseline_plan', 'Нет данных'))
+            print(format_plan(results.get('baseline_plan')))
             print("\n--- Indexed Plan ---")
-            print(results.get('indexed_plan', 'Нет данных'))
+            print(format_plan(results.get('indexed_plan')))
             print("-" * 50)
\ No newline at end of file
@@ -2,9 +2,31 @@ import psycopg2
 import threading
 import time
 import random
+import os
+import re
+from decimal import Decimal
+import sys
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from contextlib import contextmanager, nullcontext
 from psycopg2 import sql
 from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED, ISOLATION_LEVEL_REPEATABLE_READ, ISOLATION_LEVEL_SERIALIZABLE
 from psycopg2 import errors as pg_errors
+from psycopg2.pool import ThreadedConnectionPool
+
+# --- Вывод сообщений ---
+# Сообщения пишутся в очередь, а в stdout их выводит отдельный поток:
+# потоки с открытыми транзакциями не ждут записи в терминал
+logger = logging.getLogger("transactions_demo")
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper()) # LOGLEVEL=WARNING отключает вывод хода демонстраций, оставляя предупреждения и ошибки
+logger.propagate = False
+_log_queue = queue.Queue(-1)
+logger.addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+_log_listener.start()
+atexit.register(_log_listener.stop) # stop() дожидается вывода всех сообщений из очереди
 
 # --- Конфигурация подключения к БД ---
 DB_CONFIG = {
@@ -15,143 +37,343 @@ DB_CONFIG = {
     "port": "5433"
 }
 
+# --- SQL-запросы (определены один раз на уровне модуля) ---
+SQL_DROP_INDEX = sql.SQL("DROP INDEX IF EXISTS {};")
+# AVG по code_postal - index-only scan; id в ключе задает порядок для пакетного обновления
+SQL_CREATE_CODE_POSTAL_COVER_INDEX = """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_code_postal_cover
+    ON mutations_foncieres (code_postal, id) INCLUDE (valeur_fonciere);
+"""
+# Index-only scan возможен только по страницам, помеченным в карте видимости, а планировщику
+# нужна свежая статистика: после создания индекса выполняется VACUUM (ANALYZE)
+SQL_VACUUM_ANALYZE_MUTATIONS = "VACUUM (ANALYZE) mutations_foncieres;"
+SQL_DROP_CODE_POSTAL_COVER_INDEX = "DROP INDEX CONCURRENTLY IF EXISTS idx_code_postal_cover;"
+SQL_RANDOM_ID_SAMPLE = "SELECT id FROM mutations_foncieres TABLESAMPLE SYSTEM (1) LIMIT 1;"
+SQL_RANDOM_ID_FALLBACK = "SELECT id FROM mutations_foncieres ORDER BY random() LIMIT 1;"
+SQL_SELECT_DETAILS = "SELECT id, valeur_fonciere, nom_commune FROM mutations_foncieres WHERE id = %s;"
+SQL_SELECT_VALUE = "SELECT valeur_fonciere FROM mutations_foncieres WHERE id = %s;"
+SQL_UPDATE_VALUE = "UPDATE mutations_foncieres SET valeur_fonciere = %s WHERE id = %s;"
+SQL_COUNT_EXPENSIVE = "SELECT COUNT(*) FROM mutations_foncieres WHERE code_commune = %s AND valeur_fonciere > %s;"
+SQL_DELETE_BY_ID = "DELETE FROM mutations_foncieres WHERE id = %s;"
+# Средняя цена в коммуне (по снимку до вставки) возвращается вместе с ID новой записи
+SQL_INSERT_SALE = """
+    WITH avg_c AS (
+        SELECT AVG(valeur_fonciere) AS v FROM mutations_foncieres WHERE code_commune = %s
+    )
+    INSERT INTO mutations_foncieres (id_mutation, date_mutation, nature_mutation, valeur_fonciere, code_commune, nom_commune, type_local)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    RETURNING id, (SELECT v FROM avg_c);
+"""
+SQL_SELECT_COMMUNE_NAME = "SELECT nom_commune FROM mutations_foncieres WHERE code_commune = %s LIMIT 1;"
+# Возвращает одну строку: название до обновления и количество обновленных записей
+SQL_UPDATE_COMMUNE_NAME = """
+    WITH prev AS (
+        SELECT nom_commune FROM mutations_foncieres WHERE code_commune = %s LIMIT 1
+    ), upd AS (
+        UPDATE mutations_foncieres SET nom_commune = %s
+        WHERE code_commune = %s AND nom_commune = %s
+        RETURNING 1
+    )
+    SELECT (SELECT nom_commune FROM prev), (SELECT COUNT(*) FROM upd);
+"""
+SQL_RESTORE_COMMUNE_NAME = "UPDATE mutations_foncieres SET nom_commune = %s WHERE code_commune = %s;"
+# Блокирует все обновляемые строки почтового индекса в том же порядке, в котором их обновляют пачки
+SQL_LOCK_POSTAL_ROWS = """
+    SELECT 1 FROM mutations_foncieres
+    WHERE code_postal = %s AND valeur_fonciere IS NOT NULL AND valeur_fonciere > 0
+    ORDER BY id
+    FOR UPDATE;
+"""
+# Обновляет очередную пачку строк по возрастанию id;
+# возвращает последний id пачки, ее размер и мин/макс новых цен
+SQL_BULK_PRICE_UPDATE = """
+    WITH batch AS (
+        SELECT id FROM mutations_foncieres
+        WHERE code_postal = %s AND id > %s AND valeur_fonciere IS NOT NULL AND valeur_fonciere > 0
+        ORDER BY id
+        LIMIT %s
+    ), upd AS (
+        UPDATE mutations_foncieres m
+        SET valeur_fonciere = m.valeur_fonciere * %s
+        FROM batch
+        WHERE m.id = batch.id
+        RETURNING m.id, m.valeur_fonciere
+    )
+    SELECT MAX(id), COUNT(*), MIN(valeur_fonciere), MAX(valeur_fonciere) FROM upd;
+"""
+# Средняя цена по почтовому индексу читается трижды на одном соединении - план строится один раз
+SQL_PREPARE_AVG_PRICE_POSTAL = """
+    PREPARE avg_price_postal(text) AS
+    SELECT COALESCE(AVG(valeur_fonciere), 0.0) FROM mutations_foncieres WHERE code_postal = $1;
+"""
+SQL_EXECUTE_AVG_PRICE_POSTAL = "EXECUTE avg_price_postal(%s);"
+SQL_COUNT_OLDER = "SELECT COUNT(*) FROM mutations_foncieres WHERE date_mutation < %s;"
+SQL_COUNT_OLDER_FILTER = sql.SQL("COUNT(*) FILTER (WHERE date_mutation < %s)")
+SQL_DELETE_OLDER = "DELETE FROM mutations_foncieres WHERE date_mutation < %s;"
+# Партиции mutations_foncieres (пусто, если таблица не секционирована)
+SQL_LIST_PARTITIONS = """
+    SELECT n.nspname, c.relname, pg_get_expr(c.relpartbound, c.oid)
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE i.inhparent = 'mutations_foncieres'::regclass;
+"""
+SQL_DETACH_PARTITION = sql.SQL("ALTER TABLE mutations_foncieres DETACH PARTITION {};")
+SQL_DROP_TABLE = sql.SQL("DROP TABLE {};")
+PARTITION_UPPER_BOUND_RE = re.compile(r"TO \('([^']+)'\)")
+
+# Размер пула соединений: демонстрации выполняются по очереди, каждая использует до трех
+# соединений одновременно; еще одно - запас для вспомогательных функций (очистка, индексы)
+POOL_MIN_CONNECTIONS = 2
+POOL_MAX_CONNECTIONS = 4
+
+# Таймаут барьеров в демонстрациях: если второй поток упал, первый не зависнет навсегда
+BARRIER_TIMEOUT = 30
+
+# Повторы транзакции при ошибке сериализации: задержка 20/40/80/... мс
+SERIALIZATION_RETRIES = 5
+SERIALIZATION_RETRY_BASE_DELAY = 0.02
+
+# Размер пачки для массового обновления цен (строк на одну транзакцию)
+BULK_UPDATE_BATCH_SIZE = 10000
+# Допустимое отклонение средней цены от ожидаемой: каждая цена округляется до копеек (NUMERIC(18, 2))
+PRICE_CHECK_TOLERANCE = Decimal("0.01")
+
+_pool = None
+_pool_lock = threading.Lock()
+
 # --- Вспомогательные функции ---
-def get_connection(autocommit=False, isolation_level=None):
-    """Создает и возвращает новое соединение."""
-    conn = psycopg2.connect(**DB_CONFIG)
-    if isolation_level:
-        conn.set_session(isolation_level=isolation_level)
-    conn.autocommit = autocommit
-    print(f"[{threading.current_thread().name}] Подключено к БД. Уровень изоляции: {conn.isolation_level}. Autocommit: {conn.autocommit}")
+def get_pool():
+    """Возвращает общий пул соединений, создавая его при первом обращении."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadedConnectionPool(POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS, **DB_CONFIG)
+        return _pool
+
+def close_pool():
+    """Закрывает все соединения пула."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+def get_connection(autocommit=False, isolation_level=None, readonly=False, deferrable=False):
+    """
+    Берет соединение из пула и настраивает уровень изоляции и autocommit.
+    readonly/deferrable помечают сессию только для чтения (DEFERRABLE имеет смысл для SERIALIZABLE).
+    """
+    conn = get_pool().getconn()
+    conn.set_session(
+        isolation_level=isolation_level or 'DEFAULT',
+        readonly=readonly or 'DEFAULT',
+        deferrable=deferrable or 'DEFAULT',
+        autocommit=autocommit,
+    )
+    logger.info("[%s] Подключено к БД. Уровень изоляции: %s. Autocommit: %s. Только чтение: %s", threading.current_thread().name, conn.isolation_level, conn.autocommit, bool(readonly))
     return conn
 
+@contextmanager
+def borrow_connection(autocommit=False, isolation_level=None, readonly=False, deferrable=False):
+    """Берет соединение из пула на время блока with и всегда возвращает его обратно."""
+    conn = get_connection(autocommit=autocommit, isolation_level=isolation_level,
+                          readonly=readonly, deferrable=deferrable)
+    try:
+        yield conn
+    finally:
+        release_connection(conn)
+
+@contextmanager
+def prepared_statement(conn, prepare_sql, name):
+    """Готовит серверный запрос на время блока with и освобождает его (соединение вернется в пул)."""
+    with conn.cursor() as cur:
+        cur.execute(prepare_sql)
+    try:
+        yield
+    finally:
+        conn.rollback() # DEALLOCATE не выполнится в прерванной транзакции
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("DEALLOCATE {};").format(sql.Identifier(name)))
+
+def release_connection(conn):
+    """Откатывает незавершенную транзакцию, сбрасывает настройки сессии и возвращает соединение в пул."""
+    if conn.closed:
+        get_pool().putconn(conn, close=True)
+        return
+    try:
+        conn.rollback()
+        conn.set_session(isolation_level='DEFAULT', readonly='DEFAULT', deferrable='DEFAULT', autocommit=False)
+        get_pool().putconn(conn)
+    except psycopg2.Error:
+        # Сломанное соединение не возвращаем в пул для повторного использования
+        get_pool().putconn(conn, close=True)
+
 def cleanup_indexes():
-    """Удаляет индексы, созданные в задаче 1.1."""
+    """Удаляет индексы, созданные в задаче 1.1, и вспомогательный индекс, оставшийся от прерванного запуска (одним запросом)."""
     indexes_to_drop = [
         "idx_btree_code_postal",
+        "idx_hash_code_postal",
         "idx_btree_valeur_fonciere",
         "idx_btree_date_mutation",
         "idx_gin_trgm_adresse_nom_voie",
-        "idx_brin_date_mutation"
+        "idx_brin_date_mutation",
+        "idx_brin_date_mutation_32",
+        "idx_brin_date_mutation_128",
+        "idx_brin_date_mutation_512",
+        "idx_code_postal_cover"
     ]
-    print("\n--- Очистка индексов ---")
-    conn = get_connection(autocommit=True)
-    cur = conn.cursor()
-    for index_name in indexes_to_drop:
-        try:
-            print(f"Удаление индекса {index_name}...")
-            cur.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(index_name)))
-            print(f"Индекс {index_name} удален или не существовал.")
-        except psycopg2.Error as e:
-            print(f"Ошибка при удалении индекса {index_name}: {e}")
-    cur.close()
-    conn.close()
-    print("--- Очистка индексов завершена ---")
+    logger.info("\n--- Очистка индексов ---")
+    drop_sql = sql.SQL(" ").join(
+        SQL_DROP_INDEX.format(sql.Identifier(index_name)) for index_name in indexes_to_drop
+    )
+    try:
+        with borrow_connection(autocommit=True) as conn:
+            with conn.cursor() as cur:
+                logger.info("Удаление индексов: %s...", ', '.join(indexes_to_drop))
+                cur.execute(drop_sql)
+                logger.info("Индексы удалены или не существовали.")
+    except psycopg2.Error as e:
+        logger.error("Ошибка при удалении индексов: %s", e)
+    logger.info("--- Очистка индексов завершена ---")
+
+def create_support_indexes():
+    """
+    Создает покрывающий индекс для запросов по code_postal (AVG и пакетное обновление цен).
+    Индекс нужен только демонстрации обновления цен и удаляется после нее (drop_support_indexes):
+    он включает valeur_fonciere, поэтому мешает HOT-обновлениям цены и искажает baseline задачи 1.1.
+    После создания выполняется VACUUM (ANALYZE), чтобы index-only scan действительно выбирался.
+    CREATE INDEX CONCURRENTLY и VACUUM требуют autocommit.
+    """
+    logger.info("\n--- Создание вспомогательных индексов ---")
+    try:
+        with borrow_connection(autocommit=True) as conn:
+            with conn.cursor() as cur:
+                logger.info("Создание idx_code_postal_cover (code_postal, id) INCLUDE (valeur_fonciere)...")
+                cur.execute(SQL_CREATE_CODE_POSTAL_COVER_INDEX)
+                logger.info("Индекс создан (или уже существовал).")
+                logger.info("VACUUM (ANALYZE) mutations_foncieres...")
+                cur.execute(SQL_VACUUM_ANALYZE_MUTATIONS)
+    except psycopg2.Error as e:
+        logger.error("Ошибка при создании индексов: %s", e)
+    logger.info("--- Создание вспомогательных индексов завершено ---")
+
+def drop_support_indexes():
+    """Удаляет вспомогательный индекс, созданный create_support_indexes."""
+    try:
+        with borrow_connection(autocommit=True) as conn:
+            with conn.cursor() as cur:
+                logger.info("Удаление idx_code_postal_cover...")
+                cur.execute(SQL_DROP_CODE_POSTAL_COVER_INDEX)
+    except psycopg2.Error as e:
+        logger.error("Ошибка при удалении вспомогательных индексов: %s", e)
 
 def get_random_mutation_id(conn):
-    """Получает случайный ID из существующих записей для тестов."""
+    """
+    Получает случайный ID из существующих записей для тестов.
+    TABLESAMPLE читает случайные страницы вместо COUNT(*) + OFFSET по всей таблице.
+    """
     with conn.cursor() as cur:
-        cur.execute("SELECT id FROM mutations_foncieres OFFSET random() * (SELECT COUNT(*) FROM mutations_foncieres) LIMIT 1;")
+        cur.execute(SQL_RANDOM_ID_SAMPLE)
         result = cur.fetchone()
+        if result is None:
+            # Выборка может оказаться пустой на маленькой таблице
+            cur.execute(SQL_RANDOM_ID_FALLBACK)
+            result = cur.fetchone()
         return result[0] if result else None
 
 def get_mutation_details(conn, mutation_id):
     """Получает детали мутации по ID."""
     with conn.cursor() as cur:
-        cur.execute("SELECT id, valeur_fonciere, nom_commune FROM mutations_foncieres WHERE id = %s;", (mutation_id,))
+        cur.execute(SQL_SELECT_DETAILS, (mutation_id,))
         return cur.fetchone()
 
 # --- Определения Транзакций ---
-def transaction_register_sale(conn, sale_details):
+def sale_row(sale_details):
+    """Значения новой продажи в порядке колонок INSERT."""
+    return (
+        f"SALE-{random.randint(10000, 99999)}",
+        sale_details['date_mutation'],
+        'Vente',
+        sale_details['valeur_fonciere'],
+        sale_details['code_commune'],
+        sale_details['nom_commune'],
+        sale_details['type_local']
+    )
+
+def transaction_register_sale(conn, sale_details, simulate_work=False):
     """
     Транзакция 1: Регистрация новой продажи.
-    Читает среднюю цену в коммуне, затем вставляет новую запись.
+    Одним запросом читает среднюю цену в коммуне и вставляет новую запись.
+    simulate_work=True добавляет паузу перед коммитом (держит транзакцию открытой).
     """
     thread_name = threading.current_thread().name
     try:
         with conn:
             with conn.cursor() as cur:
-                # Шаг 1: Прочитать среднюю цену (для примера)
-                cur.execute("SELECT AVG(valeur_fonciere) FROM mutations_foncieres WHERE code_commune = %s;", (sale_details['code_commune'],))
-                avg_price = cur.fetchone()[0]
-                print(f"[{thread_name}] Средняя цена в {sale_details['code_commune']}: {avg_price:.2f}")
-
-                # Имитация работы
-                time.sleep(random.uniform(0.1, 0.3))
-
-                # Шаг 2: Вставить новую запись
-                insert_sql = """
-                INSERT INTO mutations_foncieres (id_mutation, date_mutation, nature_mutation, valeur_fonciere, code_commune, nom_commune, type_local)
-                VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id;
-                """
-                cur.execute(insert_sql, (
-                    f"SALE-{random.randint(10000, 99999)}",
-                    sale_details['date_mutation'],
-                    'Vente',
-                    sale_details['valeur_fonciere'],
-                    sale_details['code_commune'],
-                    sale_details['nom_commune'],
-                    sale_details['type_local']
-                ))
-                new_id = cur.fetchone()[0]
-                print(f"[{thread_name}] Успешно вставлена запись с ID: {new_id}")
+                cur.execute(SQL_INSERT_SALE, (sale_details['code_commune'],) + sale_row(sale_details))
+                new_id, avg_price = cur.fetchone()
+                logger.info("[%s] Средняя цена в %s: %.2f", thread_name, sale_details['code_commune'], avg_price)
+                logger.info("[%s] Успешно вставлена запись с ID: %s", thread_name, new_id)
+
+                if simulate_work:
+                    time.sleep(random.uniform(0.1, 0.3))
                 return new_id
     except psycopg2.Error as e:
-        print(f"[{thread_name}] Ошибка в транзакции регистрации продажи: {e}")
+        logger.error("[%s] Ошибка в транзакции регистрации продажи: %s", thread_name, e)
         return None
 
 def transaction_update_commune_name(conn, code_commune, old_name, new_name):
     """
     Транзакция 2: Обновление названия коммуны.
-    Читает текущее название и обновляет его.
+    Одним запросом читает текущее название (для проверки) и обновляет его.
+    Возвращает False, если ни одна запись не обновлена.
     """
     thread_name = threading.current_thread().name
     try:
         with conn:
             with conn.cursor() as cur:
-                # Шаг 1: Проверить текущее имя (для демонстрации)
-                cur.execute("SELECT nom_commune FROM mutations_foncieres WHERE code_commune = %s LIMIT 1;", (code_commune,))
-                current_name = cur.fetchone()
-                if current_name and current_name[0] != old_name:
-                    print(f"[{thread_name}] Предупреждение: Текущее имя '{current_name[0]}' не совпадает с ожидаемым '{old_name}' для {code_commune}.")
-
-                print(f"[{thread_name}] Обновление коммуны {code_commune} с '{old_name}' на '{new_name}'...")
-                # Имитация работы
+                logger.info("[%s] Обновление коммуны %s с '%s' на '%s'...", thread_name, code_commune, old_name, new_name)
+                cur.execute(SQL_UPDATE_COMMUNE_NAME, (code_commune, new_name, code_commune, old_name))
+                current_name, updated_count = cur.fetchone()
+                if current_name is not None and current_name != old_name:
+                    logger.warning("[%s] Предупреждение: Текущее имя '%s' не совпадает с ожидаемым '%s' для %s.", thread_name, current_name, old_name, code_commune)
+                if not updated_count:
+                    # Например, при повторе после коммита конкурента: имя уже изменено, обновлять нечего
+                    logger.info("[%s] Записей с именем '%s' для коммуны %s не найдено, ничего не обновлено.", thread_name, old_name, code_commune)
+                    return False
+                logger.info("[%s] Обновлено %s записей для коммуны %s.", thread_name, updated_count, code_commune)
+
+                # Имитация работы: блокировки строк держатся до коммита
                 time.sleep(random.uniform(0.1, 0.5))
-
-                # Шаг 2: Обновить записи
-                cur.execute("UPDATE mutations_foncieres SET nom_commune = %s WHERE code_commune = %s AND nom_commune = %s;",
-                            (new_name, code_commune, old_name))
-                updated_count = cur.rowcount
-                print(f"[{thread_name}] Обновлено {updated_count} записей для коммуны {code_commune}.")
                 return True
     except psycopg2.Error as e:
-        print(f"[{thread_name}] Ошибка в транзакции обновления коммуны: {e}")
+        logger.error("[%s] Ошибка в транзакции обновления коммуны: %s", thread_name, e)
         if isinstance(e, pg_errors.SerializationFailure):
-            print(f"[{thread_name}] !!! Поймана ОШИБКА СЕРИАЛИЗАЦИИ !!!")
+            logger.info("[%s] !!! Поймана ОШИБКА СЕРИАЛИЗАЦИИ !!!", thread_name)
+            raise # Решение о повторе принимает вызывающий код
         return False
 
 # --- Функции для демонстрации аномалий ---
 def demo_non_repeatable_read():
     """Демонстрация Non-Repeatable Read на уровне READ COMMITTED."""
-    print("\n\n--- Демонстрация Non-Repeatable Read (Уровень: READ COMMITTED) ---")
+    logger.info("\n\n--- Демонстрация Non-Repeatable Read (Уровень: READ COMMITTED) ---")
     # Выберем ID для теста
-    conn_setup = get_connection(autocommit=True)
-    mutation_id = get_random_mutation_id(conn_setup)
+    with borrow_connection(autocommit=True, readonly=True) as conn_setup:
+        mutation_id = get_random_mutation_id(conn_setup)
+        initial_details = get_mutation_details(conn_setup, mutation_id) if mutation_id else None
     if not mutation_id:
-        print("Не удалось получить ID для теста.")
-        conn_setup.close()
+        logger.error("Не удалось получить ID для теста.")
         return
-    initial_details = get_mutation_details(conn_setup, mutation_id)
-    conn_setup.close()
 
     if not initial_details:
-         print(f"Не удалось получить детали для ID {mutation_id}.")
+         logger.error("Не удалось получить детали для ID %s.", mutation_id)
          return
 
-    print(f"Тестируем на записи с ID={mutation_id}, начальное значение valeur_fonciere={initial_details[1]}")
+    logger.info("Тестируем на записи с ID=%s, начальное значение valeur_fonciere=%s", mutation_id, initial_details[1])
 
     barrier = threading.Barrier(2)
+    barrier_commit = threading.Barrier(2, timeout=BARRIER_TIMEOUT) # tx2 закоммитил / tx1 прочитал второй раз
     results = {}
 
     def tx1_reader():
@@ -161,31 +383,32 @@ def demo_non_repeatable_read():
             with conn:
                 with conn.cursor() as cur:
                     # Первое чтение
-                    cur.execute("SELECT valeur_fonciere FROM mutations_foncieres WHERE id = %s;", (mutation_id,))
+                    cur.execute(SQL_SELECT_VALUE, (mutation_id,))
                     val1 = cur.fetchone()[0]
                     results['tx1_read1'] = val1
-                    print(f"[{thread_name}] Первое чтение: valeur_fonciere = {val1}")
+                    logger.info("[%s] Первое чтение: valeur_fonciere = %s", thread_name, val1)
 
                     # Ждем, пока tx2 изменит данные
-                    print(f"[{thread_name}] Ожидание на барьере...")
+                    logger.info("[%s] Ожидание на барьере...", thread_name)
                     barrier.wait()
-                    print(f"[{thread_name}] Прошли барьер, ожидание tx2...")
-                    time.sleep(1) # Даем время tx2 закоммитить
+                    logger.info("[%s] Прошли барьер, ожидание коммита tx2...", thread_name)
+                    barrier_commit.wait()
 
                     # Второе чтение
-                    cur.execute("SELECT valeur_fonciere FROM mutations_foncieres WHERE id = %s;", (mutation_id,))
+                    cur.execute(SQL_SELECT_VALUE, (mutation_id,))
                     val2 = cur.fetchone()[0]
                     results['tx1_read2'] = val2
-                    print(f"[{thread_name}] Второе чтение: valeur_fonciere = {val2}")
+                    logger.info("[%s] Второе чтение: valeur_fonciere = %s", thread_name, val2)
+                    barrier_commit.wait() # tx2 может восстанавливать значение
 
                     if val1 != val2:
-                        print(f"[{thread_name}] !!! АНОМАЛИЯ Non-Repeatable Read: {val1} != {val2} !!!")
+                        logger.info("[%s] !!! АНОМАЛИЯ Non-Repeatable Read: %s != %s !!!", thread_name, val1, val2)
                     else:
-                        print(f"[{thread_name}] Аномалия не проявилась (возможно, tx2 не успел или откатился).")
+                        logger.warning("[%s] Аномалия не проявилась (возможно, tx2 не успел или откатился).", thread_name)
         except Exception as e:
-            print(f"[{thread_name}] Ошибка: {e}")
+            logger.error("[%s] Ошибка: %s", thread_name, e)
         finally:
-            if conn: conn.close()
+            if conn: release_connection(conn)
 
     def tx2_writer():
         conn = get_connection(isolation_level=ISOLATION_LEVEL_READ_COMMITTED)
@@ -193,20 +416,37 @@ def demo_non_repeatable_read():
         new_value = initial_details[1] + 10000
         try:
              # Ожидаем, пока tx1 сделает первое чтение
-            print(f"[{thread_name}] Ожидание на барьере...")
+            logger.info("[%s] Ожидание на барьере...", thread_name)
             barrier.wait()
-            print(f"[{thread_name}] Прошли барьер, обновление данных...")
+            logger.info("[%s] Прошли барьер, обновление данных...", thread_name)
 
             with conn:
                 with conn.cursor() as cur:
-                    cur.execute("UPDATE mutations_foncieres SET valeur_fonciere = %s WHERE id = %s;", (new_value, mutation_id))
-                    print(f"[{thread_name}] Установлено valeur_fonciere = {new_value} для ID {mutation_id}. Коммит...")
+                    cur.execute(SQL_UPDATE_VALUE, (new_value, mutation_id))
+                    logger.info("[%s] Установлено valeur_fonciere = %s для ID %s. Коммит...", thread_name, new_value, mutation_id)
             results['tx2_wrote'] = new_value
         except Exception as e:
-            print(f"[{thread_name}] Ошибка: {e}")
+            logger.error("[%s] Ошибка: %s", thread_name, e)
             results['tx2_wrote'] = None
+
+        # Отпускаем tx1 и при ошибке, затем ждем его второго чтения
+        try:
+            barrier_commit.wait()
+            barrier_commit.wait()
+        except threading.BrokenBarrierError:
+            logger.warning("[%s] Барьер сломан (tx1 не дошел до второго чтения).", thread_name)
+
+        # Восстанавливаем исходное значение тем же соединением
+        try:
+            if results.get('tx2_wrote') is not None:
+                with conn:
+                    with conn.cursor() as cur:
+                        cur.execute(SQL_UPDATE_VALUE, (initial_details[1], mutation_id))
+                logger.info("[%s] Восстановлено valeur_fonciere = %s для ID %s.", thread_name, initial_details[1], mutation_id)
+        except Exception as e:
+            logger.error("[%s] Ошибка восстановления: %s", thread_name, e)
         finally:
-            if conn: conn.close()
+            if conn: release_connection(conn)
 
     t1 = threading.Thread(target=tx1_reader, name="TX1_Reader")
     t2 = threading.Thread(target=tx2_writer, name="TX2_Writer")
@@ -216,30 +456,19 @@ def demo_non_repeatable_read():
     t1.join()
     t2.join()
 
-    # Восстанавливаем исходное значение
-    print("--- Восстановление исходного значения ---")
-    conn_cleanup = get_connection(autocommit=True)
-    try:
-        with conn_cleanup.cursor() as cur:
-             cur.execute("UPDATE mutations_foncieres SET valeur_fonciere = %s WHERE id = %s;", (initial_details[1], mutation_id))
-             print(f"Восстановлено valeur_fonciere = {initial_details[1]} для ID {mutation_id}.")
-    except Exception as e:
-        print(f"Ошибка восстановления: {e}")
-    finally:
-        conn_cleanup.close()
-
 
 def demo_phantom_read():
     """
     Демонстрация Phantom Read (проявление на READ COMMITTED, предотвращение на REPEATABLE READ).
     """
-    print("\n\n--- Демонстрация Phantom Read ---")
+    logger.info("\n\n--- Демонстрация Phantom Read ---")
     test_commune = '01053'
     test_value = 9999999
 
     # --- Тест 1: Уровень READ COMMITTED ---
-    print("\n--- Уровень: READ COMMITTED (ожидаем фантомы) ---")
+    logger.info("\n--- Уровень: READ COMMITTED (ожидаем фантомы) ---")
     barrier_rc = threading.Barrier(2)
+    barrier_rc_commit = threading.Barrier(2, timeout=BARRIER_TIMEOUT) # вставка закоммичена / второе чтение выполнено
     results_rc = {}
 
     def tx1_reader_rc():
@@ -249,30 +478,31 @@ def demo_phantom_read():
             with conn:
                 with conn.cursor() as cur:
                     # Первое чтение (количество дорогих объектов)
-                    cur.execute("SELECT COUNT(*) FROM mutations_foncieres WHERE code_commune = %s AND valeur_fonciere > %s;", (test_commune, test_value -1))
+                    cur.execute(SQL_COUNT_EXPENSIVE, (test_commune, test_value - 1))
                     count1 = cur.fetchone()[0]
                     results_rc['tx1_read1'] = count1
-                    print(f"[{thread_name}] Первое чтение: Count = {count1}")
+                    logger.info("[%s] Первое чтение: Count = %s", thread_name, count1)
 
-                    print(f"[{thread_name}] Ожидание на барьере...")
+                    logger.info("[%s] Ожидание на барьере...", thread_name)
                     barrier_rc.wait()
-                    print(f"[{thread_name}] Прошли барьер, ожидание tx2...")
-                    time.sleep(1) # Даем время tx2 вставить и закоммитить
+                    logger.info("[%s] Прошли барьер, ожидание коммита tx2...", thread_name)
+                    barrier_rc_commit.wait()
 
                     # Второе чтение
-                    cur.execute("SELECT COUNT(*) FROM mutations_foncieres WHERE code_commune = %s AND valeur_fonciere > %s;", (test_commune, test_value - 1))
+                    cur.execute(SQL_COUNT_EXPENSIVE, (test_commune, test_value - 1))
                     count2 = cur.fetchone()[0]
                     results_rc['tx1_read2'] = count2
-                    print(f"[{thread_name}] Второе чтение: Count = {count2}")
+                    logger.info("[%s] Второе чтение: Count = %s", thread_name, count2)
+                    barrier_rc_commit.wait() # tx2 может удалять фантом
 
                     if count1 != count2:
-                        print(f"[{thread_name}] !!! АНОМАЛИЯ Phantom Read: {count1} != {count2} !!!")
+                        logger.info("[%s] !!! АНОМАЛИЯ Phantom Read: %s != %s !!!", thread_name, count1, count2)
                     else:
-                         print(f"[{thread_name}] Фантом не появился (возможно, tx2 не успел или откатился).")
+                         logger.warning("[%s] Фантом не появился (возможно, tx2 не успел или откатился).", thread_name)
         except Exception as e:
-            print(f"[{thread_name}] Ошибка: {e}")
+            logger.error("[%s] Ошибка: %s", thread_name, e)
         finally:
-            if conn: conn.close()
+            if conn: release_connection(conn)
 
     def tx2_inserter_rc():
         conn = get_connection(isolation_level=ISOLATION_LEVEL_READ_COMMITTED)
@@ -283,27 +513,32 @@ def demo_phantom_read():
         }
         new_id = None
         try:
-            print(f"[{thread_name}] Ожидание на барьере...")
+            logger.info("[%s] Ожидание на барьере...", thread_name)
             barrier_rc.wait()
-            print(f"[{thread_name}] Прошли барьер, вставка 'фантомной' записи...")
+            logger.info("[%s] Прошли барьер, вставка 'фантомной' записи...", thread_name)
             new_id = transaction_register_sale(conn, sale) # Используем нашу транзакцию вставки
             results_rc['tx2_inserted'] = new_id is not None
         except Exception as e:
-            print(f"[{thread_name}] Ошибка: {e}")
+            logger.error("[%s] Ошибка: %s", thread_name, e)
             results_rc['tx2_inserted'] = False
         finally:
-            if conn: conn.close()
-            # Очистка фантомной записи
-            if new_id:
-                conn_cleanup = get_connection(autocommit=True)
-                try:
-                    with conn_cleanup.cursor() as cur:
-                        cur.execute("DELETE FROM mutations_foncieres WHERE id = %s;", (new_id,))
-                        print(f"[Cleanup] Удалена фантомная запись ID: {new_id}")
-                except Exception as e_clean:
-                    print(f"[Cleanup] Ошибка удаления фантома {new_id}: {e_clean}")
-                finally:
-                    conn_cleanup.close()
+            # Сигнализируем о коммите и ждем второго чтения tx1, только потом удаляем фантом
+            try:
+                barrier_rc_commit.wait()
+                barrier_rc_commit.wait()
+            except threading.BrokenBarrierError:
+                logger.warning("[%s] Барьер сломан (tx1 не дошел до второго чтения).", thread_name)
+            # Очистка фантомной записи тем же соединением
+            try:
+                if new_id:
+                    with conn:
+                        with conn.cursor() as cur:
+                            cur.execute(SQL_DELETE_BY_ID, (new_id,))
+                    logger.info("[Cleanup] Удалена фантомная запись ID: %s", new_id)
+            except Exception as e_clean:
+                logger.error("[Cleanup] Ошибка удаления фантома %s: %s", new_id, e_clean)
+            finally:
+                if conn: release_connection(conn)
 
 
     t1_rc = threading.Thread(target=tx1_reader_rc, name="TX1_RC_Reader")
@@ -312,8 +547,9 @@ def demo_phantom_read():
 
 
     # --- Тест 2: Уровень REPEATABLE READ ---
-    print("\n--- Уровень: REPEATABLE READ (ожидаем предотвращение фантомов) ---")
+    logger.info("\n--- Уровень: REPEATABLE READ (ожидаем предотвращение фантомов) ---")
     barrier_rr = threading.Barrier(2)
+    barrier_rr_commit = threading.Barrier(2, timeout=BARRIER_TIMEOUT) # вставка закоммичена / второе чтение выполнено
     results_rr = {}
 
     def tx1_reader_rr():
@@ -323,30 +559,31 @@ def demo_phantom_read():
             with conn:
                 with conn.cursor() as cur:
                     # Первое чтение
-                    cur.execute("SELECT COUNT(*) FROM mutations_foncieres WHERE code_commune = %s AND valeur_fonciere > %s;", (test_commune, test_value - 1))
+                    cur.execute(SQL_COUNT_EXPENSIVE, (test_commune, test_value - 1))
                     count1 = cur.fetchone()[0]
                     results_rr['tx1_read1'] = count1
-                    print(f"[{thread_name}] Первое чтение: Count = {count1}")
+                    logger.info("[%s] Первое чтение: Count = %s", thread_name, count1)
 
-                    print(f"[{thread_name}] Ожидание на барьере...")
+                    logger.info("[%s] Ожидание на барьере...", thread_name)
                     barrier_rr.wait()
-                    print(f"[{thread_name}] Прошли барьер, ожидание tx2...")
-                    time.sleep(1)
+                    logger.info("[%s] Прошли барьер, ожидание коммита tx2...", thread_name)
+                    barrier_rr_commit.wait()
 
                     # Второе чтение
-                    cur.execute("SELECT COUNT(*) FROM mutations_foncieres WHERE code_commune = %s AND valeur_fonciere > %s;", (test_commune, test_value - 1))
+                    cur.execute(SQL_COUNT_EXPENSIVE, (test_commune, test_value - 1))
                     count2 = cur.fetchone()[0]
                     results_rr['tx1_read2'] = count2
-                    print(f"[{thread_name}] Второе чтение: Count = {count2}")
+                    logger.info("[%s] Второе чтение: Count = %s", thread_name, count2)
+                    barrier_rr_commit.wait() # tx2 может удалять фантом
 
                     if count1 == count2:
-                        print(f"[{thread_name}] === Фантом не появился (как и ожидалось на REPEATABLE READ): {count1} == {count2} ===")
+                        logger.info("[%s] === Фантом не появился (как и ожидалось на REPEATABLE READ): %s == %s ===", thread_name, count1, count2)
                     else:
-                         print(f"[{thread_name}] !!! ОШИБКА: Фантом появился на REPEATABLE READ: {count1} != {count2} !!!")
+                         logger.error("[%s] !!! ОШИБКА: Фантом появился на REPEATABLE READ: %s != %s !!!", thread_name, count1, count2)
         except Exception as e:
-            print(f"[{thread_name}] Ошибка: {e}")
+            logger.error("[%s] Ошибка: %s", thread_name, e)
         finally:
-            if conn: conn.close()
+            if conn: release_connection(conn)
 
     def tx2_inserter_rr():
         conn = get_connection(isolation_level=ISOLATION_LEVEL_READ_COMMITTED)
@@ -357,26 +594,32 @@ def demo_phantom_read():
         }
         new_id = None
         try:
-            print(f"[{thread_name}] Ожидание на барьере...")
+            logger.info("[%s] Ожидание на барьере...", thread_name)
             barrier_rr.wait()
-            print(f"[{thread_name}] Прошли барьер, вставка 'фантомной' записи...")
+            logger.info("[%s] Прошли барьер, вставка 'фантомной' записи...", thread_name)
             new_id = transaction_register_sale(conn, sale)
             results_rr['tx2_inserted'] = new_id is not None
         except Exception as e:
-            print(f"[{thread_name}] Ошибка: {e}")
+            logger.error("[%s] Ошибка: %s", thread_name, e)
             results_rr['tx2_inserted'] = False
         finally:
-            if conn: conn.close()
-            if new_id:
-                conn_cleanup = get_connection(autocommit=True)
-                try:
-                    with conn_cleanup.cursor() as cur:
-                        cur.execute("DELETE FROM mutations_foncieres WHERE id = %s;", (new_id,))
-                        print(f"[Cleanup] Удалена фантомная запись ID: {new_id}")
-                except Exception as e_clean:
-                    print(f"[Cleanup] Ошибка удаления фантома {new_id}: {e_clean}")
-                finally:
-                    conn_cleanup.close()
+            # Сигнализируем о коммите и ждем второго чтения tx1, только потом удаляем фантом
+            try:
+                barrier_rr_commit.wait()
+                barrier_rr_commit.wait()
+            except threading.BrokenBarrierError:
+                logger.warning("[%s] Барьер сломан (tx1 не дошел до второго чтения).", thread_name)
+            # Очистка фантомной записи тем же соединением
+            try:
+                if new_id:
+                    with conn:
+                        with conn.cursor() as cur:
+                            cur.execute(SQL_DELETE_BY_ID, (new_id,))
+                    logger.info("[Cleanup] Удалена фантомная запись ID: %s", new_id)
+            except Exception as e_clean:
+                logger.error("[Cleanup] Ошибка удаления фантома %s: %s", new_id, e_clean)
+            finally:
+                if conn: release_connection(conn)
 
     t1_rr = threading.Thread(target=tx1_reader_rr, name="TX1_RR_Reader")
     t2_rr = threading.Thread(target=tx2_inserter_rr, name="TX2_RR_Inserter")
@@ -384,92 +627,111 @@ def demo_phantom_read():
 
 
 def demo_serialization_failure():
-    """Демонстрация Serialization Failure на уровне REPEATABLE READ."""
-    print("\n\n--- Демонстрация Serialization Failure (Уровень: REPEATABLE READ) ---")
+    """
+    Демонстрация Serialization Failure на уровне SERIALIZABLE.
+    Проигравшая транзакция повторяется с экспоненциальной задержкой.
+    """
+    logger.info("\n\n--- Демонстрация Serialization Failure (Уровень: SERIALIZABLE) ---")
     test_code_commune = '01344'
-    conn_setup = get_connection(autocommit=True)
-    try:
-        with conn_setup.cursor() as cur:
-            cur.execute("SELECT nom_commune FROM mutations_foncieres WHERE code_commune = %s LIMIT 1;", (test_code_commune,))
-            original_name = cur.fetchone()[0]
-            print(f"Тестируем на коммуне {test_code_commune}, исходное имя: '{original_name}'")
-    except Exception as e:
-        print(f"Не удалось получить имя для коммуны {test_code_commune}: {e}")
-        conn_setup.close()
-        return
-    conn_setup.close()
+    state = {} # исходное имя коммуны читает tx1 своим соединением до барьера
 
     barrier = threading.Barrier(2)
-    results = {'tx1_success': False, 'tx2_success': False}
+    results = {'tx1_success': False, 'tx2_success': False, 'tx1_retries': 0, 'tx2_retries': 0}
+
+    def update_with_retry(conn, thread_name, tx_key, new_name):
+        """Обновляет имя, повторяя транзакцию при ошибке сериализации; последняя ошибка пробрасывается."""
+        for attempt in range(SERIALIZATION_RETRIES):
+            try:
+                return transaction_update_commune_name(conn, test_code_commune, state['original_name'], new_name)
+            except pg_errors.SerializationFailure:
+                conn.rollback()
+                if attempt == SERIALIZATION_RETRIES - 1:
+                    raise
+                results[f'{tx_key}_retries'] += 1
+                delay = SERIALIZATION_RETRY_BASE_DELAY * (1 << attempt)
+                logger.info("[%s] Повтор %s/%s через %.0f мс...", thread_name, attempt + 1, SERIALIZATION_RETRIES - 1, delay * 1000)
+                time.sleep(delay)
+        return False
 
     def tx1_updater():
-        conn = get_connection(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ)
+        conn = get_connection(isolation_level=ISOLATION_LEVEL_SERIALIZABLE)
         thread_name = threading.current_thread().name
         try:
             conn.autocommit = False
-            print(f"[{thread_name}] Начало транзакции.")
+            try:
+                with conn:
+                    with conn.cursor() as cur:
+                        cur.execute(SQL_SELECT_COMMUNE_NAME, (test_code_commune,))
+                        state['original_name'] = cur.fetchone()[0]
+                logger.info("Тестируем на коммуне %s, исходное имя: '%s'", test_code_commune, state['original_name'])
+            except Exception:
+                # tx2 не должен ждать на барьере
+                barrier.abort()
+                raise
+
+            logger.info("[%s] Начало транзакции.", thread_name)
             # time.sleep(0.1)
 
-            print(f"[{thread_name}] Ожидание на барьере...")
+            logger.info("[%s] Ожидание на барьере...", thread_name)
             barrier.wait() # Синхронизация перед обновлением
-            print(f"[{thread_name}] Попытка обновления на 'Name TX1'...")
-            success = transaction_update_commune_name(conn, test_code_commune, original_name, f"{original_name}_TX1_{random.randint(0,99)}")
+            logger.info("[%s] Попытка обновления на 'Name TX1'...", thread_name)
+            success = update_with_retry(conn, thread_name, 'tx1', f"{state['original_name']}_TX1_{random.randint(0,99)}")
             results['tx1_success'] = success
             if success:
-                 print(f"[{thread_name}] Коммит...")
+                 logger.info("[%s] Коммит...", thread_name)
                  conn.commit()
             else:
-                 print(f"[{thread_name}] Откат (автоматический или из-за ошибки)...")
+                 logger.info("[%s] Откат (автоматический или из-за ошибки)...", thread_name)
                  conn.rollback()
 
         except pg_errors.SerializationFailure as e:
-            print(f"[{thread_name}] !!! ПОЙМАНА ОЖИДАЕМАЯ ОШИБКА СЕРИАЛИЗАЦИИ !!!")
+            logger.info("[%s] !!! ПОЙМАНА ОЖИДАЕМАЯ ОШИБКА СЕРИАЛИЗАЦИИ !!!", thread_name)
             results['tx1_success'] = False
             conn.rollback()
         except psycopg2.Error as e:
-            print(f"[{thread_name}] Неожиданная ошибка psycopg2: {e}")
+            logger.error("[%s] Неожиданная ошибка psycopg2: %s", thread_name, e)
             conn.rollback()
         except Exception as e:
-            print(f"[{thread_name}] Неожиданная ошибка Python: {e}")
+            logger.error("[%s] Неожиданная ошибка Python: %s", thread_name, e)
             conn.rollback()
         finally:
-            print(f"[{thread_name}] Завершение.")
-            if conn: conn.close()
+            logger.info("[%s] Завершение.", thread_name)
+            if conn: release_connection(conn)
 
     def tx2_updater():
-        conn = get_connection(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ)
+        conn = get_connection(isolation_level=ISOLATION_LEVEL_SERIALIZABLE)
         thread_name = threading.current_thread().name
         try:
             conn.autocommit = False
-            print(f"[{thread_name}] Начало транзакции.")
+            logger.info("[%s] Начало транзакции.", thread_name)
             # time.sleep(0.1)
 
-            print(f"[{thread_name}] Ожидание на барьере...")
+            logger.info("[%s] Ожидание на барьере...", thread_name)
             barrier.wait()
-            print(f"[{thread_name}] Попытка обновления на 'Name TX2'...")
+            logger.info("[%s] Попытка обновления на 'Name TX2'...", thread_name)
             time.sleep(0.3)
-            success = transaction_update_commune_name(conn, test_code_commune, original_name, f"{original_name}_TX2_{random.randint(0,99)}")
+            success = update_with_retry(conn, thread_name, 'tx2', f"{state['original_name']}_TX2_{random.randint(0,99)}")
             results['tx2_success'] = success
             if success:
-                 print(f"[{thread_name}] Коммит...")
+                 logger.info("[%s] Коммит...", thread_name)
                  conn.commit()
             else:
-                 print(f"[{thread_name}] Откат...")
+                 logger.info("[%s] Откат...", thread_name)
                  conn.rollback()
 
         except pg_errors.SerializationFailure as e:
-            print(f"[{thread_name}] !!! ПОЙМАНА ОЖИДАЕМАЯ ОШИБКА СЕРИАЛИЗАЦИИ !!!")
+            logger.info("[%s] !!! ПОЙМАНА ОЖИДАЕМАЯ ОШИБКА СЕРИАЛИЗАЦИИ !!!", thread_name)
             results['tx2_success'] = False
             conn.rollback()
         except psycopg2.Error as e:
-            print(f"[{thread_name}] Неожиданная ошибка psycopg2: {e}")
+            logger.error("[%s] Неожиданная ошибка psycopg2: %s", thread_name, e)
             conn.rollback()
         except Exception as e:
-            print(f"[{thread_name}] Неожиданная ошибка Python: {e}")
+            logger.error("[%s] Неожиданная ошибка Python: %s", thread_name, e)
             conn.rollback()
         finally:
-             print(f"[{thread_name}] Завершение.")
-             if conn: conn.close()
+             logger.info("[%s] Завершение.", thread_name)
+             if conn: release_connection(conn)
 
     t1 = threading.Thread(target=tx1_updater, name="TX1_Updater")
     t2 = threading.Thread(target=tx2_updater, name="TX2_Updater")
@@ -479,164 +741,195 @@ def demo_serialization_failure():
     t1.join()
     t2.join()
 
-    print(f"\nРезультат Serialization Failure: TX1 успех={results['tx1_success']}, TX2 успех={results['tx2_success']}")
-    if results['tx1_success'] != results['tx2_success']:
-        print("=== Одна из транзакций успешно завершилась, другая откатилась из-за конфликта (ожидаемый результат) ===")
+    if 'original_name' not in state:
+        logger.error("Не удалось получить имя для коммуны %s.", test_code_commune)
+        return
+
+    # Исходное имя возвращается один раз, после завершения обоих потоков, на autocommit-соединении
+    # (READ COMMITTED): SERIALIZABLE-восстановление из двух потоков само конфликтовало бы
+    if results['tx1_success'] or results['tx2_success']:
+        try:
+            with borrow_connection(autocommit=True) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(SQL_RESTORE_COMMUNE_NAME, (state['original_name'], test_code_commune))
+                    logger.info("[Cleanup] Восстановлено имя '%s' для коммуны %s. Затронуто строк: %s", state['original_name'], test_code_commune, cur.rowcount)
+        except Exception as e:
+            logger.error("[Cleanup] Ошибка восстановления имени коммуны: %s", e)
+
+    logger.info("\nРезультат Serialization Failure: TX1 успех=%s (повторов %s), TX2 успех=%s (повторов %s)", results['tx1_success'], results['tx1_retries'], results['tx2_success'], results['tx2_retries'])
+    if results['tx1_retries'] or results['tx2_retries']:
+        logger.info("=== Конфликт сериализации произошел и был обработан повтором транзакции (ожидаемый результат) ===")
+    elif results['tx1_success'] != results['tx2_success']:
+        logger.info("=== Одна из транзакций успешно завершилась, другая откатилась из-за конфликта ===")
     else:
-        print("--- Результат неопределен или обе транзакции завершились одинаково (возможно, конфликт не произошел как ожидалось) ---")
+        logger.warning("--- Результат неопределен или обе транзакции завершились одинаково (возможно, конфликт не произошел как ожидалось) ---")
 
-    # Восстановление исходного имени
-    print("--- Восстановление исходного имени коммуны ---")
-    conn_cleanup = get_connection(autocommit=True)
-    try:
-        with conn_cleanup.cursor() as cur:
-             cur.execute("UPDATE mutations_foncieres SET nom_commune = %s WHERE code_commune = %s;", (original_name, test_code_commune))
-             print(f"Восстановлено имя '{original_name}' для коммуны {test_code_commune}. Затронуто строк: {cur.rowcount}")
-    except Exception as e:
-        print(f"Ошибка восстановления имени коммуны: {e}")
-    finally:
-        conn_cleanup.close()
 
-def transaction_bulk_price_adjustment(conn, code_postal, percentage_change):
+def price_factor(percentage_change):
+    """Множитель цены как Decimal: умножение остается точным NUMERIC и на сервере, и в Python."""
+    return Decimal(1) + Decimal(str(percentage_change)) / 100
+
+def transaction_bulk_price_adjustment(conn, code_postal, percentage_change, batch_size=BULK_UPDATE_BATCH_SIZE,
+                                      commit_batches=True):
     """
     Транзакция 3: Массовое обновление цен на недвижимость в районе (по почтовому индексу).
     Изменяет valeur_fonciere на percentage_change процентов.
+    Строки обновляются пачками по batch_size (по возрастанию id), каждая пачка коммитится
+    отдельно, поэтому блокировки держатся только на строках текущей пачки.
+    commit_batches=False выполняет все пачки в транзакции вызывающего кода (коммит/откат - снаружи);
+    в этом режиме все строки сначала блокируются SELECT ... FOR UPDATE (по возрастанию id), чтобы
+    конкурирующий писатель ждал в очереди, а не ловил взаимоблокировку посреди обновления.
     """
     thread_name = threading.current_thread().name
     # Рассчитываем множитель: +5% -> 1.05, -10% -> 0.90
-    adjustment_factor = 1 + (percentage_change / 100.0)
-    print(f"[{thread_name}] Запуск массового обновления цен для code_postal={code_postal}, множитель={adjustment_factor:.4f}")
+    adjustment_factor = price_factor(percentage_change)
+    logger.info("[%s] Запуск массового обновления цен для code_postal=%s, множитель=%.4f, пачка=%s", thread_name, code_postal, adjustment_factor, batch_size)
+    updated_count = 0
+    last_id = 0
+    min_val = max_val = None
     try:
-        with conn: # Автоматический BEGIN/COMMIT/ROLLBACK
-            with conn.cursor() as cur:
-                sql_update = sql.SQL("""
-                    UPDATE mutations_foncieres
-                    SET valeur_fonciere = valeur_fonciere * %s
-                    WHERE code_postal = %s AND valeur_fonciere IS NOT NULL AND valeur_fonciere > 0;
-                """)
-                cur.execute(sql_update, (adjustment_factor, code_postal))
-                updated_count = cur.rowcount
-                print(f"[{thread_name}] Обновлено {updated_count} записей для code_postal {code_postal}.")
-
-                if updated_count > 0:
-                     cur.execute("SELECT MIN(valeur_fonciere), MAX(valeur_fonciere) FROM mutations_foncieres WHERE code_postal = %s;", (code_postal,))
-                     min_val, max_val = cur.fetchone()
-                     print(f"[{thread_name}] Новые мин/макс цены в {code_postal}: {min_val:.2f} / {max_val:.2f}")
-                     if min_val <= 0:
-                          print(f"[{thread_name}] ПРЕДУПРЕЖДЕНИЕ: Минимальная цена стала <= 0! Возможно, стоит откатить.")
-
-                return updated_count # Возвращаем кол-во обновленных строк
+        with conn.cursor() as cur:
+            if not commit_batches:
+                cur.execute(SQL_LOCK_POSTAL_ROWS, (code_postal,))
+                logger.info("[%s] Заблокировано %s строк для code_postal %s.", thread_name, cur.rowcount, code_postal)
+            while True:
+                with conn if commit_batches else nullcontext(): # BEGIN/COMMIT на каждую пачку
+                    cur.execute(SQL_BULK_PRICE_UPDATE, (code_postal, last_id, batch_size, adjustment_factor))
+                    batch_last_id, batch_count, batch_min, batch_max = cur.fetchone()
+                if batch_count == 0:
+                    break
+                updated_count += batch_count
+                last_id = batch_last_id
+                min_val = batch_min if min_val is None else min(min_val, batch_min)
+                max_val = batch_max if max_val is None else max(max_val, batch_max)
+            logger.info("[%s] Обновлено %s записей для code_postal %s.", thread_name, updated_count, code_postal)
+
+            if updated_count > 0:
+                 logger.info("[%s] Новые мин/макс цены в %s: %.2f / %.2f", thread_name, code_postal, min_val, max_val)
+                 if min_val <= 0:
+                      logger.warning("[%s] ПРЕДУПРЕЖДЕНИЕ: Минимальная цена стала <= 0! Возможно, стоит откатить.", thread_name)
+
+            return updated_count # Возвращаем кол-во обновленных строк
     except psycopg2.Error as e:
-        print(f"[{thread_name}] Ошибка в транзакции массового обновления цен: {e}")
+        logger.error("[%s] Ошибка в транзакции массового обновления цен: %s", thread_name, e)
+        if commit_batches and updated_count > 0:
+            logger.info("[%s] ВНИМАНИЕ: %s записей уже закоммичены предыдущими пачками.", thread_name, updated_count)
         return -1
 
+def find_partitions_before(cur, cutoff_date):
+    """Возвращает (схема, имя) партиций по date_mutation, целиком лежащих до cutoff_date."""
+    cur.execute(SQL_LIST_PARTITIONS)
+    partitions = []
+    for schema, name, bound in cur.fetchall():
+        match = PARTITION_UPPER_BOUND_RE.search(bound or "")
+        # Верхняя граница не включается, поэтому партиция с TO <= cutoff_date удаляется целиком
+        if match and match.group(1) <= str(cutoff_date):
+            partitions.append((schema, name))
+    return partitions
+
 def transaction_archive_old_mutations(conn, cutoff_date):
     """
     Транзакция 4: Архивация (удаление) старых записей о мутациях старше cutoff_date.
+    Возвращает количество строк, удаленных DELETE (строки удаленных партиций не считаются).
     ВНИМАНИЕ: Эта функция предназначена для вызова внутри обертки, которая сделает ROLLBACK.
     """
     thread_name = threading.current_thread().name
-    print(f"[{thread_name}] Запуск архивации (удаления) записей старше {cutoff_date}")
+    logger.info("[%s] Запуск архивации (удаления) записей старше %s", thread_name, cutoff_date)
     deleted_count = -1
     try:
         with conn.cursor() as cur:
-            # Шаг 1 (для информации): Посчитать, сколько будет удалено
-            sql_count = sql.SQL("SELECT COUNT(*) FROM mutations_foncieres WHERE date_mutation < %s;")
-            cur.execute(sql_count, (cutoff_date,))
-            count_to_delete = cur.fetchone()[0]
-            print(f"[{thread_name}] Найдено {count_to_delete} записей для удаления (старше {cutoff_date}).")
-
-            if count_to_delete == 0:
-                 print(f"[{thread_name}] Нет записей для удаления.")
-                 # Если нечего удалять, считаем операцию успешной (0 удалено)
-                 # Нужно закоммитить пустую транзакцию или откатить - зависит от внешней логики
-                 # Здесь просто вернем 0, чтобы внешний код решил.
+            # Если таблица секционирована по date_mutation, старые партиции отсоединяются и удаляются целиком.
+            # DETACH без CONCURRENTLY, чтобы операция оставалась в транзакции и откатывалась оберткой.
+            old_partitions = find_partitions_before(cur, cutoff_date)
+            for schema, name in old_partitions:
+                partition = sql.Identifier(schema, name)
+                cur.execute(SQL_DETACH_PARTITION.format(partition))
+                cur.execute(SQL_DROP_TABLE.format(partition))
+                logger.info("[%s] Удалена партиция %s.%s.", thread_name, schema, name)
+
+            # Остаток (частично попавшие партиции или несекционированная таблица) удаляется DELETE;
+            # количество удаленных строк берем из rowcount, без отдельного COUNT(*)
+            logger.info("[%s] Выполнение DELETE...", thread_name)
+            cur.execute(SQL_DELETE_OLDER, (cutoff_date,))
+            deleted_count = cur.rowcount
+
+            if deleted_count == 0 and not old_partitions:
+                 logger.info("[%s] Нет записей для удаления.", thread_name)
                  return 0 # Важно вернуть не -1
 
-            # Шаг 2: Удаление
-            print(f"[{thread_name}] Выполнение DELETE...")
-            sql_delete = sql.SQL("DELETE FROM mutations_foncieres WHERE date_mutation < %s;")
-            cur.execute(sql_delete, (cutoff_date,))
-            deleted_count = cur.rowcount
-            print(f"[{thread_name}] Успешно удалено {deleted_count} записей (внутри транзакции).")
-            if deleted_count != count_to_delete:
-                 print(f"[{thread_name}] ПРЕДУПРЕЖДЕНИЕ: Количество удаленных ({deleted_count}) не совпадает с подсчитанным ({count_to_delete})!")
-                 # Это может случиться, если кто-то удалил строки между COUNT и DELETE,
-                 # даже на REPEATABLE READ, если другая транзакция закоммитила удаление.
-                 # На SERIALIZABLE это вызвало бы ошибку сериализации.
+            logger.info("[%s] Успешно удалено %s записей DELETE и %s партиций (внутри транзакции).", thread_name, deleted_count, len(old_partitions))
 
             # Возвращаем количество для внешней логики (которая сделает ROLLBACK)
             return deleted_count
     except psycopg2.Error as e:
-        print(f"[{thread_name}] Ошибка в транзакции архивации: {e}")
+        logger.error("[%s] Ошибка в транзакции архивации: %s", thread_name, e)
         # Откат будет выполнен снаружи
         return -1 # Явная индикация ошибки
 
 # --- Функция для безопасного теста архивации с принудительным откатом ---
-def run_archive_test_with_rollback(cutoff_date):
+def count_older_for_dates(cur, cutoff_dates):
+    """Количество записей старше каждой из дат - одним проходом по таблице."""
+    query = sql.SQL("SELECT {} FROM mutations_foncieres WHERE date_mutation < %s;").format(
+        sql.SQL(", ").join(SQL_COUNT_OLDER_FILTER for _ in cutoff_dates)
+    )
+    cur.execute(query, list(cutoff_dates) + [max(cutoff_dates)])
+    return dict(zip(cutoff_dates, cur.fetchone()))
+
+def run_archive_tests_with_rollback(cutoff_dates):
     """
-    Запускает транзакцию архивации в отдельной сессии
-    и гарантированно откатывает изменения после выполнения.
+    Запускает транзакцию архивации для каждой даты на одном соединении.
+    Каждый запуск изолирован SAVEPOINT и откатывается ROLLBACK TO SAVEPOINT,
+    в конце вся транзакция гарантированно откатывается.
     """
-    print(f"\n--- Тестовый запуск архивации (с гарантированным ROLLBACK) для даты < {cutoff_date} ---")
-    conn = None
-    initial_count = -1
+    cutoff_dates = list(cutoff_dates)
+    logger.info("\n--- Тестовый запуск архивации (с гарантированным ROLLBACK) для дат: %s ---", ', '.join(cutoff_dates))
     try:
-        # Получаем соединение без автокоммита
-        conn = get_connection(autocommit=False, isolation_level=ISOLATION_LEVEL_READ_COMMITTED)
-
-        # 1. Проверяем исходное количество записей до начала
-        with conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM mutations_foncieres WHERE date_mutation < %s;", (cutoff_date,))
-            initial_count = cur.fetchone()[0]
-            print(f"[TestRunner] Исходное количество записей старше {cutoff_date}: {initial_count}")
-
-        if initial_count == 0:
-            print("[TestRunner] Нет записей для тестового удаления. Пропуск демонстрации удаления.")
-            return
-
-        print("[TestRunner] Начало транзакции для теста архивации.")
-        # 2. Выполняем функцию архивации (которая делает DELETE)
-        deleted_count = transaction_archive_old_mutations(conn, cutoff_date)
-
-        if deleted_count >= 0:
-            print(f"[TestRunner] Транзакция архивации сообщила об удалении {deleted_count} записей.")
-            # 3. Проверка ВНУТРИ транзакции (удаленные строки не должны быть видны)
-            with conn.cursor() as cur:
-                 cur.execute("SELECT COUNT(*) FROM mutations_foncieres WHERE date_mutation < %s;", (cutoff_date,))
-                 count_after_delete = cur.fetchone()[0]
-                 print(f"[TestRunner] Проверка ВНУТРИ транзакции: записей старше {cutoff_date} = {count_after_delete} (ожидается 0)")
-                 if count_after_delete != 0:
-                      print("[TestRunner] ПРЕДУПРЕЖДЕНИЕ: Проверка внутри транзакции показала не 0 записей после удаления!")
-        else:
-            print("[TestRunner] Транзакция архивации завершилась с ошибкой.")
-
-    except Exception as e:
-        print(f"[TestRunner] Ошибка во время теста архивации: {e}")
-    finally:
-        if conn and not conn.closed:
-            # 4. Гарантированный ROLLBACK в любом случае
-            print("[TestRunner] Выполнение ROLLBACK для отмены изменений теста архивации...")
-            conn.rollback()
-            print("[TestRunner] ROLLBACK выполнен.")
-            # 5. Проверка ПОСЛЕ отката (данные должны вернуться)
+        with borrow_connection(autocommit=False, isolation_level=ISOLATION_LEVEL_READ_COMMITTED) as conn:
             try:
                 with conn.cursor() as cur:
-                     cur.execute("SELECT COUNT(*) FROM mutations_foncieres WHERE date_mutation < %s;", (cutoff_date,))
-                     count_after_rollback = cur.fetchone()[0]
-                     print(f"[TestRunner] Проверка ПОСЛЕ ROLLBACK: записей старше {cutoff_date} = {count_after_rollback} (ожидается {initial_count})")
-                     if count_after_rollback != initial_count:
-                          print(f"[TestRunner] !!! ОШИБКА: Количество записей после отката ({count_after_rollback}) не совпадает с исходным ({initial_count}) !!!")
-
-            except Exception as e_check:
-                 print(f"[TestRunner] Ошибка проверки после отката: {e_check}")
+                    # 1. Исходное количество записей для всех дат одним запросом
+                    initial_counts = count_older_for_dates(cur, cutoff_dates)
+                    for cutoff_date in cutoff_dates:
+                        logger.info("[TestRunner] Исходное количество записей старше %s: %s", cutoff_date, initial_counts[cutoff_date])
+
+                    for cutoff_date in cutoff_dates:
+                        initial_count = initial_counts[cutoff_date]
+                        logger.info("\n[TestRunner] --- Архивация для даты < %s ---", cutoff_date)
+                        if initial_count == 0:
+                            logger.info("[TestRunner] Нет записей для тестового удаления. Пропуск демонстрации удаления.")
+                            continue
+
+                        cur.execute("SAVEPOINT archive_test;")
+                        # 2. Выполняем функцию архивации (которая делает DELETE)
+                        deleted_count = transaction_archive_old_mutations(conn, cutoff_date)
+
+                        if deleted_count >= 0:
+                            logger.info("[TestRunner] Транзакция архивации сообщила об удалении %s записей.", deleted_count)
+                            # 3. Проверка ВНУТРИ транзакции (удаленные строки не должны быть видны)
+                            cur.execute(SQL_COUNT_OLDER, (cutoff_date,))
+                            count_after_delete = cur.fetchone()[0]
+                            logger.info("[TestRunner] Проверка ВНУТРИ транзакции: записей старше %s = %s (ожидается 0)", cutoff_date, count_after_delete)
+                            if count_after_delete != 0:
+                                logger.warning("[TestRunner] ПРЕДУПРЕЖДЕНИЕ: Проверка внутри транзакции показала не 0 записей после удаления!")
+                        else:
+                            logger.error("[TestRunner] Транзакция архивации завершилась с ошибкой.")
+
+                        # 4. Откат к точке сохранения (работает и после ошибки внутри нее)
+                        logger.info("[TestRunner] Выполнение ROLLBACK TO SAVEPOINT для отмены изменений теста архивации...")
+                        cur.execute("ROLLBACK TO SAVEPOINT archive_test;")
+
+                        # 5. Проверка ПОСЛЕ отката (данные должны вернуться)
+                        cur.execute(SQL_COUNT_OLDER, (cutoff_date,))
+                        count_after_rollback = cur.fetchone()[0]
+                        logger.info("[TestRunner] Проверка ПОСЛЕ ROLLBACK: записей старше %s = %s (ожидается %s)", cutoff_date, count_after_rollback, initial_count)
+                        if count_after_rollback != initial_count:
+                            logger.error("[TestRunner] !!! ОШИБКА: Количество записей после отката (%s) не совпадает с исходным (%s) !!!", count_after_rollback, initial_count)
             finally:
-                 conn.close()
-                 print("[TestRunner] Соединение для теста архивации закрыто.")
-        elif conn and conn.closed:
-             print("[TestRunner] Соединение уже было закрыто перед блоком finally (неожиданно).")
-        else:
-             print("[TestRunner] Соединение не было установлено.")
+                # Гарантированный ROLLBACK всей транзакции в любом случае
+                conn.rollback()
+                logger.info("[TestRunner] ROLLBACK выполнен, соединение возвращается в пул.")
+    except Exception as e:
+        logger.error("[TestRunner] Ошибка во время теста архивации: %s", e)
 
 
 # --- Основной блок выполнения ---
@@ -644,145 +937,85 @@ if __name__ == "__main__":
     # 1. Очистка индексов от предыдущего задания
     cleanup_indexes()
 
-    # 2. Демонстрация аномалий
+    # 2. Демонстрация аномалий (по очереди: вывод каждой демонстрации читается последовательно,
+    # а случайная запись NRR может оказаться в коммуне фантомной демонстрации или демонстрации сериализации)
     demo_non_repeatable_read()
     demo_phantom_read()
     demo_serialization_failure()
 
 
-    print("\n\n--- Демонстрация дополнительных полезных транзакций ---")
+    logger.info("\n\n--- Демонстрация дополнительных полезных транзакций ---")
 
     # 3.1 Демонстрация массового обновления цен
-    print("\n--- Тест транзакции: Массовое обновление цен (+5% в 75015) ---")
-    test_postal_code = '51200.0' # Пример: 15-й округ Парижа
-    percentage = 5.0 # Увеличить на 5%
-    initial_avg_price = 0
-    conn_setup = get_connection(autocommit=True)
+    # Покрывающий индекс существует только на время этой демонстрации
+    create_support_indexes()
     try:
-        with conn_setup.cursor() as cur:
-            sql_avg = sql.SQL("SELECT COALESCE(AVG(valeur_fonciere), 0.0) FROM mutations_foncieres WHERE code_postal = %s;")
-            cur.execute(sql_avg, (test_postal_code,))
-            res = cur.fetchone()
-            initial_avg_price = res[0]
-            print(f"Начальная средняя цена для {test_postal_code}: {initial_avg_price:.2f}")
-    except psycopg2.Error as e:
-        print(f"Ошибка БД при получении начальной цены для {test_postal_code}: {e}")
-        initial_avg_price = 0.0
-    except Exception as e:
-        print(f"Не удалось получить начальную цену для {test_postal_code}: {e}")
+        logger.info("\n--- Тест транзакции: Массовое обновление цен (+5% в 75015) ---")
+        test_postal_code = '51200.0' # Пример: 15-й округ Парижа
+        percentage = 5.0 # Увеличить на 5%
+        # Начальная цена, обновление и проверка выполняются в одной транзакции, которая затем откатывается:
+        # исходные цены восстанавливаются точно, без обратного UPDATE
         initial_avg_price = 0.0
-    finally:
-        if conn_setup: conn_setup.close()
-
-    # Выполняем транзакцию обновления
-    conn_update = get_connection(autocommit=False, isolation_level=ISOLATION_LEVEL_READ_COMMITTED)
-    updated_count = -1
-    if initial_avg_price > 0:
         try:
-            updated_count = transaction_bulk_price_adjustment(conn_update, test_postal_code, percentage)
-            if updated_count >= 0:
-                print(f"Транзакция обновления цен для {test_postal_code} вернула {updated_count}. Коммит...")
-                conn_update.commit()
-                print("Коммит выполнен.")
-
-                # Проверка после коммита
-                conn_check = get_connection(autocommit=True)
-                final_avg_price = 0.0
+            with borrow_connection(autocommit=False, isolation_level=ISOLATION_LEVEL_READ_COMMITTED) as conn_update, \
+                    prepared_statement(conn_update, SQL_PREPARE_AVG_PRICE_POSTAL, "avg_price_postal"):
                 try:
-                    with conn_check.cursor() as cur:
-                        sql_avg_check = sql.SQL(
-                            "SELECT COALESCE(AVG(valeur_fonciere), 0.0) FROM mutations_foncieres WHERE code_postal = %s;")
-                        cur.execute(sql_avg_check, (test_postal_code,))
-                        final_avg_price = cur.fetchone()[0]
-                        print(f"Финальная средняя цена для {test_postal_code}: {final_avg_price:.2f}")
-
-                        # Сравнение
-                        if initial_avg_price > 0:
-                            expected_price = initial_avg_price * (1 + percentage / 100.0)
-                            print(f"(Ожидаемая цена ~ {expected_price:.2f})")
-                            if abs(final_avg_price - expected_price) / initial_avg_price < 0.01:
-                                print("Изменение цены соответствует ожидаемому.")
+                    with conn_update.cursor() as cur:
+                        cur.execute(SQL_EXECUTE_AVG_PRICE_POSTAL, (test_postal_code,))
+                        initial_avg_price = cur.fetchone()[0]
+                    logger.info("Начальная средняя цена для %s: %.2f", test_postal_code, initial_avg_price)
+
+                    if initial_avg_price > 0:
+                        updated_count = transaction_bulk_price_adjustment(conn_update, test_postal_code, percentage,
+                                                                          commit_batches=False)
+                        if updated_count >= 0:
+                            logger.info("Транзакция обновления цен для %s вернула %s.", test_postal_code, updated_count)
+
+                            # Проверка внутри транзакции (изменения видны только ей)
+                            with conn_update.cursor() as cur:
+                                cur.execute(SQL_EXECUTE_AVG_PRICE_POSTAL, (test_postal_code,))
+                                final_avg_price = cur.fetchone()[0]
+                            logger.info("Средняя цена внутри транзакции для %s: %.2f", test_postal_code, final_avg_price)
+
+                            # Сравнение
+                            expected_price = initial_avg_price * price_factor(percentage)
+                            logger.info("(Ожидаемая цена ~ %.2f)", expected_price)
+                            if (final_avg_price - expected_price).copy_abs() <= PRICE_CHECK_TOLERANCE:
+                                logger.info("Изменение цены соответствует ожидаемому.")
                             else:
-                                print("ПРЕДУПРЕЖДЕНИЕ: Изменение цены НЕ соответствует ожидаемому.")
+                                logger.warning("ПРЕДУПРЕЖДЕНИЕ: Изменение цены НЕ соответствует ожидаемому.")
                         else:
-                            print("Не удалось сравнить с исходной ценой (она была 0 или не получена).")
-
-                except psycopg2.Error as e:
-                    print(f"Ошибка БД при проверке после коммита: {e}")
-                except Exception as e:
-                    print(f"Неожиданная ошибка проверки после коммита: {e}")
+                            logger.error("Транзакция обновления цен для %s не удалась.", test_postal_code)
+                    else:
+                        logger.info("Пропуск обновления цен для %s, так как исходная средняя цена была 0 (нет данных).", test_postal_code)
                 finally:
-                    if conn_check: conn_check.close()
-
-            else:
-                print(
-                    f"Транзакция обновления цен для {test_postal_code} не удалась. Откат (автоматический через with)...")
-                # conn_update.rollback() не нужен
+                    logger.info("\n--- Откат массового обновления цен для восстановления данных (%s) ---", test_postal_code)
+                    conn_update.rollback()
+                    logger.info("ROLLBACK выполнен.")
+
+                # Проверка после отката (цены должны совпасть с исходными)
+                if initial_avg_price > 0:
+                    with conn_update:
+                        with conn_update.cursor() as cur:
+                            cur.execute(SQL_EXECUTE_AVG_PRICE_POSTAL, (test_postal_code,))
+                            restored_avg_price = cur.fetchone()[0]
+                    logger.info("Восстановленная средняя цена для %s: %.2f (исходная была %.2f)", test_postal_code, restored_avg_price, initial_avg_price)
+                    if restored_avg_price == initial_avg_price:
+                        logger.info("Цена успешно восстановлена.")
+                    else:
+                        logger.warning("ПРЕДУПРЕЖДЕНИЕ: Цена после отката отличается от исходной (данные изменены другой транзакцией?).")
+        except psycopg2.Error as e:
+            logger.error("Ошибка БД во время обновления цен для %s: %s", test_postal_code, e)
         except Exception as e:
-            print(f"Внешняя ошибка во время выполнения обновления цен: {e}")
-            if conn_update and not conn_update.closed and conn_update.status == psycopg2.extensions.STATUS_IN_TRANSACTION:
-                print("Выполнение отката из-за внешней ошибки...")
-                conn_update.rollback()
-        finally:
-            if conn_update and not conn_update.closed: conn_update.close()
-
-    else:
-        print(f"Пропуск обновления цен для {test_postal_code}, так как исходная средняя цена была 0 (нет данных).")
-        if conn_update and not conn_update.closed: conn_update.close()  # Закрываем неиспользованное соединение
-
-        # Откатываем изменение, ЕСЛИ обновление было применено (updated_count > 0)
-    if updated_count > 0:
-        print(f"\n--- Откат массового обновления цен для восстановления данных ({test_postal_code}) ---")
-        conn_rollback = get_connection(autocommit=False, isolation_level=ISOLATION_LEVEL_READ_COMMITTED)
-        try:
-            rollback_factor = 1.0 / (1 + percentage / 100.0)
-            rollback_percentage = (rollback_factor - 1) * 100.0
-            print(
-                f"Выполнение обратного обновления с множителем: {rollback_factor:.6f} (процент ~{rollback_percentage:.4f}%)")
-            rollback_count = transaction_bulk_price_adjustment(conn_rollback, test_postal_code, rollback_percentage)
-            if rollback_count >= 0:
-                print(f"Откат обновления цен выполнен. Затронуто {rollback_count} записей. Коммит отката...")
-                conn_rollback.commit()
-                # Финальная проверка
-                conn_final_check = get_connection(autocommit=True)
-                restored_avg_price = 0.0
-                try:
-                    with conn_final_check.cursor() as cur:
-                        sql_avg_final = sql.SQL(
-                            "SELECT COALESCE(AVG(valeur_fonciere), 0.0) FROM mutations_foncieres WHERE code_postal = %s;")
-                        cur.execute(sql_avg_final, (test_postal_code,))
-                        restored_avg_price = cur.fetchone()[0]
-                        print(
-                            f"Восстановленная средняя цена для {test_postal_code}: {restored_avg_price:.2f} (исходная была {initial_avg_price:.2f})")
-                        if initial_avg_price > 0 and abs(
-                                restored_avg_price - initial_avg_price) / initial_avg_price < 0.001:  # Допуск 0.1%
-                            print("Цена успешно восстановлена.")
-                        elif initial_avg_price == 0 and restored_avg_price == 0:
-                            print("Цена осталась 0 (как и была).")
-                        else:
-                            print("ПРЕДУПРЕЖДЕНИЕ: Цена после отката отличается от исходной.")
-                except psycopg2.Error as e:
-                    print(f"Ошибка БД при финальной проверке отката: {e}")
-                except Exception as e:
-                    print(f"Неожиданная ошибка финальной проверке отката: {e}")
-                finally:
-                    if conn_final_check: conn_final_check.close()
-            else:
-                print("Транзакция отката обновления цен не удалась. Откат...")
-                conn_rollback.rollback()
-
-        except Exception as e_rb:
-            print(f"Ошибка при откате обновления цен: {e_rb}")
-            if conn_rollback and not conn_rollback.closed and conn_rollback.status == psycopg2.extensions.STATUS_IN_TRANSACTION:
-                conn_rollback.rollback()
-        finally:
-            if conn_rollback and not conn_rollback.closed: conn_rollback.close()
+            logger.error("Внешняя ошибка во время выполнения обновления цен: %s", e)
+    finally:
+        drop_support_indexes()
 
-        # 3.2 Демонстрация архивации с гарантированным откатом
+    # 3.2 Демонстрация архивации с гарантированным откатом
     archive_date_test_1 = '2017-01-10'
     archive_date_test_2 = '2018-01-01'
 
-    run_archive_test_with_rollback(archive_date_test_1)
-    run_archive_test_with_rollback(archive_date_test_2)
+    run_archive_tests_with_rollback([archive_date_test_1, archive_date_test_2])
 
-    print("\n\n--- Все демонстрации завершены ---")
\ No newline at end of file
+    close_pool()
+    logger.info("\n\n--- Все демонстрации завершены ---")
\ No newline at end of file
@@ -1,9 +1,11 @@
 import psycopg2
 import time
-import re
+import json
 import secrets
+import atexit
 from psycopg2 import sql
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, STATUS_IN_TRANSACTION
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_values
 from contextlib import contextmanager
 
 # --- Конфигурация подключения к БД ---
@@ -18,23 +20,66 @@ DB_CONFIG = {
 # Глобальная переменная для отслеживания доступности pg_bigm
 pg_bigm_available = False
 
+# Пул соединений: демонстрации по очереди берут и возвращают соединения вместо переподключения
+POOL_MIN_CONNECTIONS = 1
+POOL_MAX_CONNECTIONS = 8
+_pool = None
+
+# Параметры сессии для построения GIN индексов: больше памяти под сортировку и параллельные воркеры
+GIN_MAINTENANCE_WORK_MEM = '1GB'
+GIN_PARALLEL_MAINTENANCE_WORKERS = 4
+
+# Параметры pgp_sym_encrypt для демо: AES-128 вместо CAST5 по умолчанию, без сжатия
+# и с минимальным числом итераций S2K (см. обсуждение производительности в demo_pgcrypto)
+PGP_SYM_OPTIONS = 'cipher-algo=aes128, compress-algo=0, s2k-count=1024'
+
+# Префикс NOTICE, которым DO-блок setup_extensions сообщает о неудачной установке расширения;
+# по нему такие сообщения отличаются от штатных "extension ... already exists, skipping"
+EXTENSION_FAILURE_NOTICE_PREFIX = 'EXTENSION_INSTALL_FAILED'
+
 # --- Вспомогательные функции ---
+def get_pool():
+    """Возвращает пул соединений, создавая его при первом обращении."""
+    global _pool
+    if _pool is None:
+        _pool = ThreadedConnectionPool(POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS, **DB_CONFIG)
+        atexit.register(_pool.closeall)
+    return _pool
+
+def release_connection(conn):
+    """Сбрасывает настройки сессии и возвращает соединение в пул (сломанное - закрывает)."""
+    if conn.closed:
+        get_pool().putconn(conn, close=True)
+        return
+    try:
+        conn.rollback()
+        # RESET ALL вне транзакции, чтобы SET-параметры демонстрации не достались следующему пользователю пула
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("RESET ALL")
+        conn.set_session(isolation_level='DEFAULT', autocommit=False)
+        get_pool().putconn(conn)
+    except psycopg2.Error:
+        get_pool().putconn(conn, close=True)
+
 @contextmanager
 def db_connection(autocommit=False, isolation_level=None):
-    """Контекстный менеджер для управления соединением с БД."""
+    """Контекстный менеджер: берет соединение из пула и возвращает его после использования."""
     conn = None
+    # Транзакцию завершаем без проверки conn.status: commit/rollback без открытой транзакции - no-op
+    manage_transaction = not autocommit
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
+        conn = get_pool().getconn()
         if autocommit:
-            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.autocommit = True
         elif isolation_level:
             conn.set_session(isolation_level=isolation_level)
         yield conn
-        if not autocommit and conn.status == STATUS_IN_TRANSACTION:
+        if manage_transaction:
             conn.commit()
     except psycopg2.Error as e:
         print(f"Ошибка подключения или выполнения операции: {e}")
-        if conn and not autocommit and conn.status == STATUS_IN_TRANSACTION:
+        if conn and manage_transaction:
             try:
                 conn.rollback()
                 print("Выполнен откат транзакции из-за ошибки.")
@@ -44,71 +89,57 @@ def db_connection(autocommit=False, isolation_level=None):
             raise
     finally:
         if conn:
-            conn.close()
+            release_connection(conn)
 
 def execute_query(conn, query, params=None, analyze=False, fetch_one=False, fetch_all=False):
     """Универсальная функция для выполнения SQL с улучшенной защитой в EXPLAIN ANALYZE."""
     cur = conn.cursor()
-    base_sql_string = ""
     query_to_run = ""
-    start_time = time.time()
+    start_time = time.perf_counter()
     results = None
     plan = None
     exec_time_ms = None
     error_occurred = None
 
     try:
-        if isinstance(query, sql.Composed):
-            base_sql_string = query.as_string(conn)
-        elif isinstance(query, str):
-            base_sql_string = query
-        else:
+        if not isinstance(query, (sql.Composable, str)):
              raise ValueError(f"Неподдерживаемый тип запроса: {type(query)}")
 
-        query_to_run = f"EXPLAIN ANALYZE {base_sql_string}" if analyze else base_sql_string
+        # В строку запрос собирается только для EXPLAIN ANALYZE; иначе Composable передается в execute как есть
+        if analyze:
+            base_sql_string = query.as_string(conn) if isinstance(query, sql.Composable) else query
+            query_to_run = f"EXPLAIN (ANALYZE, FORMAT JSON) {base_sql_string}"
+        else:
+            query_to_run = query
 
         cur.execute(query_to_run, params)
 
         if analyze:
-            explain_output_rows = None
-            try:
-                explain_output_rows = cur.fetchall()
-                plan_lines = []
-                for i, row in enumerate(explain_output_rows):
-                    if isinstance(row, tuple) and len(row) > 0 and row[0] is not None:
-                        try:
-                            plan_lines.append(str(row[0]))
-                        except Exception as e_str:
-                             print(f"Предупреждение: Ошибка приведения к строке элемента {i} плана: {row[0]} ({e_str})")
-                             plan_lines.append(f"!!ERROR CONVERTING ROW {i}!!")
+            results = None
+            # EXPLAIN (FORMAT JSON) возвращает одну строку с одной json-колонкой
+            if not cur.description or len(cur.description) != 1:
+                error_occurred = ValueError(f"ожидалась одна колонка в выводе EXPLAIN ANALYZE, получено: {cur.description}")
+                print(f"Ошибка обработки плана EXPLAIN ANALYZE: {error_occurred}")
+                plan = f"Ошибка обработки плана: {error_occurred}"
+                exec_time_ms = (time.perf_counter() - start_time) * 1000
+            else:
+                try:
+                    # psycopg2 сам декодирует json-колонку EXPLAIN в list/dict
+                    plan_json = cur.fetchone()[0]
+                    if isinstance(plan_json, str):
+                        plan_json = json.loads(plan_json)
+                    plan = plan_json[0]
+                    if "Execution Time" in plan:
+                        exec_time_ms = plan["Execution Time"]
                     else:
-                        print(f"Предупреждение: Пропущена неожиданная строка {i} в выводе EXPLAIN ANALYZE: {row}")
+                        exec_time_ms = (time.perf_counter() - start_time) * 1000
+                        print("Предупреждение: Execution Time не найдено в плане, используется общее время.")
 
-                explain_output = "\n".join(plan_lines)
-                plan = explain_output
-                match = re.search(r"Execution Time: ([\d\.]+) ms", explain_output)
-                if match:
-                    exec_time_ms = float(match.group(1))
-                else:
-                    exec_time_ms = (time.time() - start_time) * 1000
-                    if plan and "ERROR" not in plan:
-                         print("Предупреждение: Execution Time не найдено в плане, используется общее время.")
-                results = None
-
-            except psycopg2.Error as e_fetch_analyze:
-                 print(f"Ошибка psycopg2 при fetchall для EXPLAIN ANALYZE: {e_fetch_analyze}")
-                 plan = f"Ошибка получения плана: {e_fetch_analyze}"
-                 exec_time_ms = (time.time() - start_time) * 1000
-                 results = None
-                 error_occurred = e_fetch_analyze
-            except IndexError as e_index:
-                 print(f"!!! Поймана IndexError при обработке плана EXPLAIN ANALYZE: {e_index}")
-                 problem_row_info = f"Проблемная строка (возможно): {row}" if 'row' in locals() else "Строка неизвестна"
-                 print(problem_row_info)
-                 plan = f"Ошибка обработки плана: {e_index}\n{problem_row_info}"
-                 exec_time_ms = (time.time() - start_time) * 1000
-                 results = None
-                 error_occurred = e_index
+                except psycopg2.Error as e_fetch_analyze:
+                     print(f"Ошибка psycopg2 при fetchall для EXPLAIN ANALYZE: {e_fetch_analyze}")
+                     plan = f"Ошибка получения плана: {e_fetch_analyze}"
+                     exec_time_ms = (time.perf_counter() - start_time) * 1000
+                     error_occurred = e_fetch_analyze
 
 
         elif fetch_one:
@@ -118,7 +149,7 @@ def execute_query(conn, query, params=None, analyze=False, fetch_one=False, fetc
                  print(f"Ошибка psycopg2 при fetchone: {e_fetch}")
                  results = None
                  error_occurred = e_fetch
-            exec_time_ms = (time.time() - start_time) * 1000
+            exec_time_ms = (time.perf_counter() - start_time) * 1000
         elif fetch_all:
             try:
                 results = cur.fetchall()
@@ -126,13 +157,14 @@ def execute_query(conn, query, params=None, analyze=False, fetch_one=False, fetc
                  print(f"Ошибка psycopg2 при fetchall: {e_fetch}")
                  results = None
                  error_occurred = e_fetch
-            exec_time_ms = (time.time() - start_time) * 1000
+            exec_time_ms = (time.perf_counter() - start_time) * 1000
         else:
-            exec_time_ms = (time.time() - start_time) * 1000
+            exec_time_ms = (time.perf_counter() - start_time) * 1000
 
     except psycopg2.Error as e:
         print(f"Ошибка выполнения запроса:")
-        print(f"SQL: {query_to_run[:500]}...")
+        sql_text = query_to_run.as_string(conn) if isinstance(query_to_run, sql.Composable) else query_to_run
+        print(f"SQL: {sql_text[:500]}...")
         print(f"Параметры: {params}")
         print(f"Ошибка psycopg2: {e.pgcode} {e.pgerror}")
         error_occurred = e
@@ -154,7 +186,7 @@ def execute_query(conn, query, params=None, analyze=False, fetch_one=False, fetc
         "error": error_occurred
     }
     if result_dict["time_ms"] is None:
-        result_dict["time_ms"] = (time.time() - start_time) * 1000
+        result_dict["time_ms"] = (time.perf_counter() - start_time) * 1000
 
     return result_dict
 
@@ -185,34 +217,34 @@ def setup_extensions(conn):
     print("\n--- Установка расширений ---")
     extensions = {"pg_trgm": False, "pg_bigm": False, "pgcrypto": False}
 
+    # Все CREATE EXTENSION - одним DO-блоком; недоступное расширение не прерывает установку остальных
+    create_sql = sql.SQL("DO $$ BEGIN {} END $$;").format(sql.SQL(" ").join(
+        sql.SQL("BEGIN CREATE EXTENSION IF NOT EXISTS {}; EXCEPTION WHEN OTHERS THEN RAISE NOTICE {}, {}, SQLERRM; END;")
+            .format(sql.Identifier(ext), sql.Literal(f"{EXTENSION_FAILURE_NOTICE_PREFIX} %: %"), sql.Literal(ext))
+        for ext in extensions
+    ))
+    try:
+        print(f"Попытка установки {', '.join(extensions)}...")
+        execute_query(conn, create_sql)
+        for notice in conn.notices:
+            if EXTENSION_FAILURE_NOTICE_PREFIX in notice:
+                print(f"Предупреждение: {notice.strip()}")
+        del conn.notices[:]
+
+        check_sql = "SELECT extname FROM pg_extension WHERE extname = ANY(%s);"
+        result = execute_query(conn, check_sql, params=(list(extensions),), fetch_all=True)
+        installed = {row[0] for row in (result.get('results') or [])}
+    except Exception as e_other:
+        print(f"Неожиданная ошибка при установке расширений: {e_other}")
+        installed = set()
+
     for ext in extensions:
-        try:
-            print(f"Попытка установки {ext}...")
-            execute_query(conn, sql.SQL("CREATE EXTENSION IF NOT EXISTS {}").format(sql.Identifier(ext)))
-            check_sql = "SELECT 1 FROM pg_extension WHERE extname = %s;"
-            result = execute_query(conn, check_sql, params=(ext,), fetch_one=True)
-            if result and result.get('results'):
-                 print(f"Расширение {ext} успешно установлено или уже существует.")
-                 extensions[ext] = True
-                 if ext == 'pg_bigm':
-                     pg_bigm_available = True
-            else:
-                 print(f"Не удалось подтвердить установку расширения {ext}.")
-                 if ext == 'pg_bigm':
-                      pg_bigm_available = False
-
-        except psycopg2.Error as e:
-            if "is not available" in str(e.pgerror) or "does not exist" in str(e.pgerror):
-                 print(f"Предупреждение: Расширение {ext} не доступно для установки в этой сборке PostgreSQL.")
-                 print(f"  >> {e.pgerror}")
-                 if ext == 'pg_bigm':
-                      pg_bigm_available = False
-            else:
-                 print(f"Не удалось установить расширение {ext}: {e}")
-        except Exception as e_other:
-             print(f"Неожиданная ошибка при установке {ext}: {e_other}")
-             if ext == 'pg_bigm':
-                 pg_bigm_available = False
+        if ext in installed:
+            print(f"Расширение {ext} успешно установлено или уже существует.")
+            extensions[ext] = True
+        else:
+            print(f"Не удалось подтвердить установку расширения {ext}.")
+    pg_bigm_available = extensions["pg_bigm"]
 
     if not pg_bigm_available:
         print("\n*** Расширение pg_bigm недоступно. Тесты для pg_bigm будут пропущены. ***\n")
@@ -220,38 +252,22 @@ def setup_extensions(conn):
 def cleanup_test_objects(conn):
     """Удаляет тестовые индексы и колонки."""
     print("\n--- Очистка тестовых объектов ---")
-    objects_to_drop = [
-        ("INDEX", "idx_gin_trgm_adresse"),
-        ("INDEX", "idx_gin_bigm_adresse"),
-        ("COLUMN", "owner_secret_info")
-    ]
-    with conn.cursor() as cur:
-        for obj_type, obj_name in objects_to_drop:
-            try:
-                if obj_type == "INDEX":
-                    print(f"Попытка удаления индекса {obj_name}...")
-                    cur.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(obj_name)))
-                    print(f"Индекс {obj_name} удален или не существовал.")
-                elif obj_type == "COLUMN":
-                     print(f"Попытка удаления колонки {obj_name}...")
-                     cur.execute("""
-                         SELECT column_name
-                         FROM information_schema.columns
-                         WHERE table_schema = 'public' AND table_name = 'mutations_foncieres' AND column_name = %s;
-                     """, (obj_name,))
-                     if cur.fetchone():
-                         cur.execute(sql.SQL("ALTER TABLE mutations_foncieres DROP COLUMN {}").format(sql.Identifier(obj_name)))
-                         print(f"Колонка {obj_name} удалена.")
-                     else:
-                          print(f"Колонка {obj_name} не найдена, удаление не требуется.")
-
-            except psycopg2.Error as e:
-                 if "does not exist" not in str(e.pgerror):
-                      print(f"Ошибка при удалении {obj_type} {obj_name}: {e}")
-                 else:
-                      print(f"{obj_type} {obj_name} уже не существует.")
-            except Exception as e_other:
-                 print(f"Неожиданная ошибка при удалении {obj_type} {obj_name}: {e_other}")
+    index_names = ["idx_gin_trgm_adresse", "idx_gin_bigm_adresse"]
+    column_name = "owner_secret_info"
+    # IF EXISTS избавляет от предварительной проверки в information_schema; все DDL - за один запрос
+    cleanup_sql = sql.SQL("DROP INDEX IF EXISTS {}; ALTER TABLE mutations_foncieres DROP COLUMN IF EXISTS {};").format(
+        sql.SQL(", ").join(map(sql.Identifier, index_names)),
+        sql.Identifier(column_name)
+    )
+    try:
+        print(f"Удаление индексов {', '.join(index_names)} и колонки {column_name}...")
+        with conn.cursor() as cur:
+            cur.execute(cleanup_sql)
+        print("Индексы и колонка удалены или не существовали.")
+    except psycopg2.Error as e:
+        print(f"Ошибка при удалении тестовых объектов: {e}")
+    except Exception as e_other:
+        print(f"Неожиданная ошибка при удалении тестовых объектов: {e_other}")
     print("Очистка завершена.")
 
 def demo_trgm_bigm():
@@ -260,7 +276,19 @@ def demo_trgm_bigm():
     target_column = "adresse_nom_voie"
     results = {}
 
+    column = sql.Identifier(target_column)
+
     with db_connection(autocommit=True) as conn:
+        # Шаблоны запросов собираются один раз и переиспользуются для pg_trgm и pg_bigm;
+        # колонка подставляется тем же sql.Identifier, что и в DDL.
+        # Оператор схожести % записывается как %%, т.к. запросы выполняются с параметрами.
+        like_query = sql.SQL("SELECT COUNT(*) FROM mutations_foncieres WHERE {col} LIKE %s").format(col=column)
+        similar_query = sql.SQL("SELECT {col}, similarity({col}, %s) FROM mutations_foncieres WHERE {col} %% %s ORDER BY similarity({col}, %s) DESC LIMIT 5").format(col=column)
+        distance_query = sql.SQL("SELECT {col}, {col} <-> %s AS dist FROM mutations_foncieres ORDER BY {col} <-> %s LIMIT 5").format(col=column)
+
+        # Настройки сессии для ускорения построения GIN индексов (сбрасываются при возврате соединения в пул)
+        execute_query(conn, sql.SQL("SET maintenance_work_mem = {}").format(sql.Literal(GIN_MAINTENANCE_WORK_MEM)))
+        execute_query(conn, sql.SQL("SET max_parallel_maintenance_workers = {}").format(sql.Literal(GIN_PARALLEL_MAINTENANCE_WORKERS)))
 
         # --- pg_trgm ---
         print("\n--- Тестирование pg_trgm ---")
@@ -270,7 +298,7 @@ def demo_trgm_bigm():
             print(f"Создание GIN индекса ({index_name_trgm}) на {target_column} с gin_trgm_ops...")
             timing_trgm_create = execute_query(conn,
                 sql.SQL("CREATE INDEX {} ON mutations_foncieres USING gin ({} gin_trgm_ops);")
-                    .format(sql.Identifier(index_name_trgm), sql.Identifier(target_column))
+                    .format(sql.Identifier(index_name_trgm), column)
             )
             # Проверяем, что результат содержит время
             if timing_trgm_create and timing_trgm_create.get('time_ms') is not None:
@@ -294,8 +322,7 @@ def demo_trgm_bigm():
                 # Запрос LIKE
                 print("Тест LIKE '%AVENUE%' с pg_trgm...")
                 timing_trgm_like = execute_query(conn,
-                     sql.SQL("SELECT COUNT(*) FROM mutations_foncieres WHERE {} LIKE %s")
-                        .format(sql.Identifier(target_column)),
+                     like_query,
                      params=('%AVENUE%',), analyze=True
                 )
                 # Сохраняем время, если оно получено
@@ -309,32 +336,21 @@ def demo_trgm_bigm():
                 # Запрос на схожесть (%)
                 search_term_similar = 'BOULVERD PEREIRE'
                 print(f"Тест схожести (%) для '{search_term_similar}' с pg_trgm...")
-                timing_trgm_similar = execute_query(conn,
-                    sql.SQL("SELECT {}, similarity({}, %s) FROM mutations_foncieres WHERE {} % %s ORDER BY similarity({}, %s) DESC LIMIT 5")
-                       .format(sql.Identifier(target_column),
-                               sql.Identifier(target_column),
-                               sql.Identifier(target_column),
-                               sql.Identifier(target_column)),
-                    params=(search_term_similar, search_term_similar, search_term_similar), analyze=True
-                )
-                if timing_trgm_similar and timing_trgm_similar.get('time_ms') is not None:
-                    results['trgm_similar_ms'] = timing_trgm_similar['time_ms']
-                    print(f"Время выполнения теста схожести: {format_metric(results['trgm_similar_ms'])} ms")
-                else:
-                     results['trgm_similar_ms'] = 'Error'
-                     print(f"Время выполнения теста схожести: Error")
-
-                print("Найденные похожие улицы:")
+                # Один проход: строки и время берутся из одного выполнения (без повторного EXPLAIN ANALYZE)
                 similar_rows_data = None
                 try: # Обернем получение данных в try/except
                     similar_rows_exec = execute_query(conn,
-                        sql.SQL("SELECT {}, similarity({}, %s) FROM mutations_foncieres WHERE {} % %s ORDER BY similarity({}, %s) DESC LIMIT 5")
-                           .format(sql.Identifier(target_column),
-                                   sql.Identifier(target_column),
-                                   sql.Identifier(target_column),
-                                   sql.Identifier(target_column)),
+                        similar_query,
                         params=(search_term_similar, search_term_similar, search_term_similar), fetch_all=True
                     )
+                    if similar_rows_exec and similar_rows_exec.get('error') is None and similar_rows_exec.get('time_ms') is not None:
+                        results['trgm_similar_ms'] = similar_rows_exec['time_ms']
+                        print(f"Время выполнения теста схожести: {format_metric(results['trgm_similar_ms'])} ms")
+                    else:
+                        results['trgm_similar_ms'] = 'Error'
+                        print(f"Время выполнения теста схожести: Error")
+
+                    print("Найденные похожие улицы:")
                     # Более надежная проверка
                     if similar_rows_exec and isinstance(similar_rows_exec.get('results'), (list, tuple)):
                         similar_rows_data = similar_rows_exec['results']
@@ -366,30 +382,20 @@ def demo_trgm_bigm():
                  # Запрос на дистанцию (<->)
                 search_term_distance = 'RUE DE LA PAIX'
                 print(f"Тест дистанции (<->) к '{search_term_distance}' с pg_trgm...")
-                timing_trgm_distance = execute_query(conn,
-                    sql.SQL("SELECT {}, {} <-> %s AS dist FROM mutations_foncieres ORDER BY {} <-> %s LIMIT 5")
-                       .format(sql.Identifier(target_column),
-                               sql.Identifier(target_column),
-                               sql.Identifier(target_column)),
-                    params=(search_term_distance, search_term_distance), analyze=True
-                )
-                if timing_trgm_distance and timing_trgm_distance.get('time_ms') is not None:
-                    results['trgm_distance_ms'] = timing_trgm_distance['time_ms']
-                    print(f"Время выполнения теста дистанции: {format_metric(results['trgm_distance_ms'])} ms")
-                else:
-                    results['trgm_distance_ms'] = 'Error'
-                    print(f"Время выполнения теста дистанции: Error")
-
-                print("Найденные ближайшие улицы:")
                 distance_rows_data = None
                 try: # Обернем получение данных в try/except
                     distance_rows_exec = execute_query(conn,
-                         sql.SQL("SELECT {}, {} <-> %s AS dist FROM mutations_foncieres ORDER BY {} <-> %s LIMIT 5")
-                           .format(sql.Identifier(target_column),
-                                   sql.Identifier(target_column),
-                                   sql.Identifier(target_column)),
+                        distance_query,
                         params=(search_term_distance, search_term_distance), fetch_all=True
                     )
+                    if distance_rows_exec and distance_rows_exec.get('error') is None and distance_rows_exec.get('time_ms') is not None:
+                        results['trgm_distance_ms'] = distance_rows_exec['time_ms']
+                        print(f"Время выполнения теста дистанции: {format_metric(results['trgm_distance_ms'])} ms")
+                    else:
+                        results['trgm_distance_ms'] = 'Error'
+                        print(f"Время выполнения теста дистанции: Error")
+
+                    print("Найденные ближайшие улицы:")
                     # Более надежная проверка
                     if distance_rows_exec and isinstance(distance_rows_exec.get('results'), (list, tuple)):
                         distance_rows_data = distance_rows_exec['results']
@@ -447,7 +453,7 @@ def demo_trgm_bigm():
                 print(f"Создание GIN индекса ({index_name_bigm}) на {target_column} с gin_bigm_ops...")
                 timing_bigm_create = execute_query(conn,
                     sql.SQL("CREATE INDEX {} ON mutations_foncieres USING gin ({} gin_bigm_ops);")
-                        .format(sql.Identifier(index_name_bigm), sql.Identifier(target_column))
+                        .format(sql.Identifier(index_name_bigm), column)
                 )
                 if timing_bigm_create and timing_bigm_create.get('time_ms') is not None:
                     results['bigm_create_ms'] = timing_bigm_create['time_ms']
@@ -468,8 +474,7 @@ def demo_trgm_bigm():
                     # Запрос LIKE
                     print("Тест LIKE '%AVENUE%' с pg_bigm...")
                     timing_bigm_like = execute_query(conn,
-                         sql.SQL("SELECT COUNT(*) FROM mutations_foncieres WHERE {} LIKE %s")
-                            .format(sql.Identifier(target_column)),
+                         like_query,
                          params=('%AVENUE%',), analyze=True
                     )
                     if timing_bigm_like and timing_bigm_like.get('time_ms') is not None:
@@ -509,15 +514,25 @@ def demo_trgm_bigm():
 
     # --- Сравнение и выводы ---
     print("\n--- Сравнение pg_trgm и pg_bigm ---")
-    header = f"{'Метрика':<25} | {'pg_trgm':<20} | {'pg_bigm':<20}"
+    header = f"{'Метрика':<30} | {'pg_trgm':<20} | {'pg_bigm':<20}"
     print(header)
     print("-" * len(header))
-    print(f"{'Время создания (ms)':<25} | {format_metric(results.get('trgm_create_ms', 'N/A')):<20} | {format_metric(results.get('bigm_create_ms', 'N/A')):<20}")
-    print(f"{'Размер индекса':<25} | {str(results.get('trgm_size', 'N/A')):<20} | {str(results.get('bigm_size', 'N/A')):<20}")
-    print(f"{'Время LIKE (ms)':<25} | {format_metric(results.get('trgm_like_ms', 'N/A')):<20} | {format_metric(results.get('bigm_like_ms', 'N/A')):<20}")
-    print(f"{'Время схожести (ms)':<25} | {format_metric(results.get('trgm_similar_ms', 'N/A')):<20} | {format_metric(results.get('bigm_similar_ms', 'N/A')):<20}")
-    print(f"{'Время дистанции (ms)':<25} | {format_metric(results.get('trgm_distance_ms', 'N/A')):<20} | {format_metric(results.get('bigm_distance_ms', 'N/A')):<20}")
+    # (подпись, метрика, форматирование): размер индекса уже строка, остальное - время в ms.
+    # LIKE замеряется на сервере (Execution Time из EXPLAIN ANALYZE), остальное - на клиенте
+    # (время вызова вместе с передачей строк), поэтому способ замера указан в подписи
+    comparison_rows = [
+        ('Время создания (ms, клиент)', 'create_ms', format_metric),
+        ('Размер индекса', 'size', str),
+        ('Время LIKE (ms, сервер)', 'like_ms', format_metric),
+        ('Время схожести (ms, клиент)', 'similar_ms', format_metric),
+        ('Время дистанции (ms, клиент)', 'distance_ms', format_metric),
+    ]
+    for label, metric, fmt in comparison_rows:
+        trgm_value = fmt(results.get(f'trgm_{metric}', 'N/A'))
+        bigm_value = fmt(results.get(f'bigm_{metric}', 'N/A'))
+        print(f"{label:<30} | {trgm_value:<20} | {bigm_value:<20}")
     print("-" * len(header))
+    print("сервер - Execution Time из EXPLAIN ANALYZE; клиент - полное время вызова, включая получение строк.")
 
     # --- Плюсы и минусы ---
     print("\nПлюсы и минусы:")
@@ -567,33 +582,40 @@ def demo_pgcrypto():
     # Работаем в транзакции для шифрования/дешифрования
     try:
         with db_connection() as conn_tx:
-            # Выбираем несколько ID для теста
+            # Выбираем несколько ID для теста и готовим секреты
             print("Выбор записей для шифрования...")
             selected_rows_result = execute_query(conn_tx,
                  "SELECT id, nom_commune FROM mutations_foncieres WHERE type_local = 'Maison' AND longitude IS NOT NULL LIMIT 3;", # Добавил условие, чтобы найти что-то
                  fetch_all=True
             )
-            selected_rows = selected_rows_result.get('results')
-
-            if not selected_rows:
+            selected_rows = selected_rows_result.get('results') or []
+            # Случайные суффиксы для всех строк - одним запросом к источнику энтропии, по 8 байт на строку
+            entropy = secrets.token_bytes(8 * len(selected_rows))
+            rows_to_encrypt = [
+                (row_id, f"Секретный контакт для {commune_name}: {entropy[i * 8:(i + 1) * 8].hex()}")
+                for i, (row_id, commune_name) in enumerate(selected_rows)
+            ]
+
+            if not rows_to_encrypt:
                  print("Не найдены записи 'Maison' для теста. Пропуск шифрования.")
                  # Не выходим, чтобы оценка pgcrypto все равно вывелась
             else:
-                test_ids = [row[0] for row in selected_rows]
+                test_ids = [row_id for row_id, _ in rows_to_encrypt]
                 print(f"Будут зашифрованы данные для ID: {test_ids}")
 
-                # Шифрование
+                # Шифрование: все строки одним UPDATE ... FROM (VALUES ...) вместо UPDATE на каждую строку
                 print("\nШифрование данных...")
-                for row_id, commune_name in selected_rows:
-                     secret_data = f"Секретный контакт для {commune_name}: {secrets.token_hex(8)}"
+                for row_id, secret_data in rows_to_encrypt:
                      print(f"  Шифруем '{secret_data}' для ID {row_id}...")
-                     # Используем pgp_sym_encrypt с паролем
-                     encrypt_sql = sql.SQL("""
-                         UPDATE mutations_foncieres
-                         SET {} = pgp_sym_encrypt(%s, %s)
-                         WHERE id = %s;
-                     """).format(sql.Identifier(test_column_name))
-                     execute_query(conn_tx, encrypt_sql, params=(secret_data, encryption_key, row_id))
+                # Используем pgp_sym_encrypt с паролем
+                encrypt_sql = sql.SQL("""
+                    UPDATE mutations_foncieres
+                    SET {} = pgp_sym_encrypt(v.secret, {}, {})
+                    FROM (VALUES %s) AS v(id, secret)
+                    WHERE mutations_foncieres.id = v.id;
+                """).format(sql.Identifier(test_column_name), sql.Literal(encryption_key), sql.Literal(PGP_SYM_OPTIONS))
+                with conn_tx.cursor() as cur:
+                    execute_values(cur, encrypt_sql, rows_to_encrypt, template="(%s::integer, %s::text)")
 
                 print("Шифрование завершено (в транзакции).")
                 # Коммит произойдет при выходе из 'with'
@@ -606,30 +628,21 @@ def demo_pgcrypto():
         try:
             with db_connection() as conn_verify:
                 print("\nПроверка зашифрованных данных...")
-                # 1. Попытка прочитать зашифрованные данные напрямую
-                print("Чтение зашифрованной колонки напрямую:")
-                select_raw_sql = sql.SQL("SELECT id, {} FROM mutations_foncieres WHERE id = ANY(%s);") \
-                                     .format(sql.Identifier(test_column_name))
-                raw_data_result = execute_query(conn_verify, select_raw_sql, params=(test_ids,), fetch_all=True)
-                raw_data = raw_data_result.get('results')
-                if raw_data:
-                    for row_id, raw_bytes in raw_data:
-                        # psycopg2 возвращает BYTEA как memoryview или bytes
-                        display_bytes = bytes(raw_bytes)[:20] if raw_bytes else "NULL"
-                        print(f"  ID {row_id}: {display_bytes}...")
-
-                # 2. Дешифрование данных
-                print("\nДешифрование данных с помощью ключа:")
+                # 1-2. Зашифрованные данные напрямую и дешифрование с помощью ключа - одним запросом.
+                # Для превью с сервера передаются только первые 20 байт шифротекста, а не BYTEA целиком.
+                # Результат читается целиком (fetch_all): строк не больше трех, а именованный курсор
+                # добавил бы лишние обращения к серверу (DECLARE/FETCH/CLOSE) без выигрыша по памяти
+                print("Чтение зашифрованной колонки напрямую и дешифрование с помощью ключа:")
                 decrypt_sql = sql.SQL("""
-                    SELECT id, pgp_sym_decrypt({}, %s) AS decrypted_info
+                    SELECT id, substring({col} FROM 1 FOR 20) AS raw_preview, pgp_sym_decrypt({col}, %s) AS decrypted_info
                     FROM mutations_foncieres
                     WHERE id = ANY(%s);
-                """).format(sql.Identifier(test_column_name))
+                """).format(col=sql.Identifier(test_column_name))
                 decrypted_data_result = execute_query(conn_verify, decrypt_sql, params=(encryption_key, test_ids), fetch_all=True)
-                decrypted_data = decrypted_data_result.get('results')
-                if decrypted_data:
-                     for row_id, info in decrypted_data:
-                          print(f"  ID {row_id}: {info}")
+                for row_id, raw_bytes, info in decrypted_data_result.get('results') or []:
+                     # psycopg2 возвращает BYTEA как memoryview или bytes
+                     display_bytes = bytes(raw_bytes) if raw_bytes else "NULL"
+                     print(f"  ID {row_id}: {display_bytes}... -> {info}")
 
                 # 3. Попытка дешифрования с неверным ключом
                 print("\nПопытка дешифрования с неверным ключом:")
@@ -667,6 +680,8 @@ def demo_pgcrypto():
     print("   - [+] Функции PGP (`pgp_sym_encrypt`) включают встроенную проверку целостности (MDC - Modification Detection Code).")
     print("3. Доступность и Производительность:")
     print("   - [-] Шифрование/дешифрование требует процессорного времени, что замедляет операции INSERT/UPDATE/SELECT, работающие с зашифрованными полями.")
+    print(f"   - [+/-] В демо используется '{PGP_SYM_OPTIONS}': AES-128 ускоряется аппаратно (AES-NI), а минимальный s2k-count удешевляет выработку ключа из пароля.")
+    print("     Цена - слабая защита от перебора пароля: для реальных данных s2k-count стоит оставлять по умолчанию или использовать длинный случайный ключ.")
     print("   - [-] Прямой поиск по зашифрованным данным (например, `WHERE decrypted_field = 'value'`) очень неэффективен, так как требует дешифрования 'на лету' для каждой строки.")
     print("   - [-] Индексирование зашифрованных данных для быстрого поиска затруднено (требуются специальные подходы, например, детерминированное шифрование с ограниченной безопасностью или отдельные индексы на хешах).")
     print("4. Сложность:")
@@ -1,9 +1,12 @@
 import zipfile
+import shutil
 import pandas as pd
+from pandas.api.types import union_categoricals, is_bool_dtype, is_numeric_dtype
 from pathlib import Path
 import logging
 from typing import List, Optional, Tuple
 import io
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Настройка логирования ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,6 +20,115 @@ ZIP_FILENAMES = ["full_2017.csv.zip", "full_2018.csv.zip", "full_2019.csv.zip"]
 EXPECTED_CSV_NAMES = [name.replace('.zip', '') for name in ZIP_FILENAMES]
 # Имя для итогового объединенного CSV файла
 OUTPUT_CSV_FILENAME = "full_171819.csv"
+# Анализировать объединенный датасет. Если False - CSV файлы склеиваются потоком
+# прямо из архивов, без загрузки в память (только объединение и сохранение).
+# ВНИМАНИЕ: потоковый режим сохраняет значения как в исходных файлах, а pandas переписывает
+# числовые колонки с пропусками как float (code_postal 51200 -> "51200.0"). Скрипты заданий
+# (например, 1.2.py с кодом '51200.0') рассчитаны на выгрузку через pandas.
+ANALYZE_COMBINED = True
+# Размер блока при потоковом копировании CSV из архива
+STREAM_COPY_CHUNK_SIZE = 16 * 1024 * 1024
+# Буфер чтения поверх распаковываемого файла: zlib распаковывает крупными блоками
+ZIP_READ_BUFFER_SIZE = 8 * 1024 * 1024
+# Число строк, форматируемых за раз при сохранении в CSV (ограничивает пиковую память to_csv)
+CSV_WRITE_CHUNK_ROWS = 200_000
+# Строковая колонка переводится в category, если доля уникальных значений ниже порога
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+# Параметры чтения CSV: C-парсер с low_memory=False определяет тип по всей колонке, поэтому коды
+# вида "01" ... "2A" (code_departement, code_commune) остаются строками с ведущими нулями.
+# Движок pyarrow не подходит: он угадывает типы по первому блоку (~1 МБ) и читает date_mutation как datetime64
+CSV_READ_OPTIONS = {"low_memory": False}
+
+def downcast_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Уменьшает потребление памяти DataFrame'ом сразу после чтения.
+
+    Целые колонки сужаются до минимального подходящего типа, строковые колонки с небольшим
+    числом уникальных значений переводятся в category. Вещественные колонки не трогаются:
+    float32 исказил бы стоимость и координаты, которые затем загружаются в NUMERIC.
+
+    Args:
+        df: DataFrame для преобразования (изменяется на месте).
+
+    Returns:
+        Тот же DataFrame с суженными типами.
+    """
+    for col in df.columns:
+        kind = df[col].dtype.kind
+        if kind == 'i':
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+        elif kind == 'u':
+            df[col] = pd.to_numeric(df[col], downcast='unsigned')
+        elif kind == 'O' and len(df) > 0:
+            if df[col].nunique(dropna=True) / len(df) < CATEGORY_MAX_UNIQUE_RATIO:
+                df[col] = df[col].astype('category')
+    return df
+
+def concat_dataframes(dataframes: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Объединяет DataFrame'ы по строкам через pd.concat.
+
+    Колонки, которые во всех файлах имеют тип category, сначала приводятся к общему набору
+    категорий (union_categoricals): иначе pd.concat развернул бы их в object. Пиковая память -
+    исходные DataFrame'ы плюс результат; исходные освобождаются после возврата из функции
+    (список очищается).
+
+    Args:
+        dataframes: Список DataFrame'ов; после вызова список очищается.
+
+    Returns:
+        Объединенный DataFrame с индексом 0..N-1.
+    """
+    categorical_columns = [
+        col for col in dataframes[0].columns
+        if all(col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype) for df in dataframes)
+    ]
+    for col in categorical_columns:
+        categories = union_categoricals([df[col] for df in dataframes]).categories
+        for df in dataframes:
+            df[col] = df[col].cat.set_categories(categories)
+
+    combined_df = pd.concat(dataframes, ignore_index=True)
+    dataframes.clear()
+    return combined_df
+
+def read_csv_from_zip(zip_path: Path, csv_filename: str) -> Optional[pd.DataFrame]:
+    """
+    Читает один CSV файл из zip-архива. Выполняется в потоке пула read_combine_from_zips.
+
+    Args:
+        zip_path: Путь к zip-архиву.
+        csv_filename: Имя CSV-файла внутри архива.
+
+    Returns:
+        DataFrame с суженными типами или None, если файл пропущен из-за ошибки.
+        MemoryError не перехватывается и передается вызывающему коду.
+    """
+    if not zip_path.is_file():
+        logging.warning(f"Файл архива не найден: {zip_path}. Пропуск.")
+        return None
+
+    try:
+        logging.info(f"Открытие архива: {zip_path} для чтения {csv_filename}...")
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            if csv_filename not in zip_ref.namelist():
+                logging.warning(f"Файл {csv_filename} не найден внутри архива {zip_path}. Пропуск.")
+                return None
+
+            with zip_ref.open(csv_filename, 'r') as raw_file, \
+                    io.BufferedReader(raw_file, buffer_size=ZIP_READ_BUFFER_SIZE) as csv_file:
+                df = downcast_dataframe(pd.read_csv(csv_file, **CSV_READ_OPTIONS))
+                logging.info(f"Прочитан {csv_filename} из {zip_path}. Форма: {df.shape}")
+                return df
+
+    except zipfile.BadZipFile:
+        logging.error(f"Ошибка: Файл {zip_path} не является zip-архивом или поврежден.")
+    except pd.errors.EmptyDataError:
+        logging.warning(f"Файл {csv_filename} в архиве {zip_path} пуст. Пропуск.")
+    except pd.errors.ParserError as e:
+        logging.error(f"Ошибка парсинга файла {csv_filename} из {zip_path}: {e}.")
+    return None
 
 def read_combine_from_zips(zip_files: List[str],
                            csv_names: List[str],
@@ -40,42 +152,40 @@ def read_combine_from_zips(zip_files: List[str],
     dataframes: List[pd.DataFrame] = []
     first_file_columns = None
 
-    for zip_filename, csv_filename in zip(zip_files, csv_names):
-        zip_path = source_dir / zip_filename
-        if not zip_path.is_file():
-            logging.warning(f"Файл архива не найден: {zip_path}. Пропуск.")
-            continue
-
-        try:
-            logging.info(f"Открытие архива: {zip_path} для чтения {csv_filename}...")
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                if csv_filename not in zip_ref.namelist():
-                    logging.warning(f"Файл {csv_filename} не найден внутри архива {zip_path}. Пропуск.")
-                    continue
-
-                with zip_ref.open(csv_filename, 'r') as csv_file:
-                    df = pd.read_csv(csv_file, low_memory=False)
-                    logging.info(f"Прочитан {csv_filename} из {zip_path}. Форма: {df.shape}")
-
-                    if first_file_columns is None:
-                        first_file_columns = set(df.columns)
-                    elif set(df.columns) != first_file_columns:
-                        logging.warning(f"Набор колонок в {csv_filename} отличается от первого файла!")
-
-                    dataframes.append(df)
-
-        except zipfile.BadZipFile:
-            logging.error(f"Ошибка: Файл {zip_path} не является zip-архивом или поврежден.")
-        except pd.errors.EmptyDataError:
-            logging.warning(f"Файл {csv_filename} в архиве {zip_path} пуст. Пропуск.")
-        except pd.errors.ParserError as e:
-            logging.error(f"Ошибка парсинга файла {csv_filename} из {zip_path}: {e}.")
-        except MemoryError:
-             logging.error(f"Ошибка нехватки памяти при чтении {csv_filename} из {zip_path}.")
-             logging.error("Попробуйте использовать чтение по частям (chunking) или увеличьте доступную память.")
-             return None
-        except Exception as e:
-            logging.error(f"Неожиданная ошибка при обработке {zip_path}/{csv_filename}: {e}")
+    # Архивы независимы: распаковка (zlib) и парсинг (C-парсер pandas) отпускают GIL,
+    # поэтому файлы читаются параллельно в потоках. Потоки, в отличие от процессов, не копируют
+    # готовые DataFrame'ы через pipe
+    zip_paths = [source_dir / zip_filename for zip_filename in zip_files]
+    executor = ThreadPoolExecutor(max_workers=max(1, len(zip_paths)))
+    try:
+        futures = [executor.submit(read_csv_from_zip, zip_path, csv_filename)
+                   for zip_path, csv_filename in zip(zip_paths, csv_names)]
+
+        for future, zip_path, csv_filename in zip(futures, zip_paths, csv_names):
+            try:
+                df = future.result()
+            except MemoryError:
+                logging.error(f"Ошибка нехватки памяти при чтении {csv_filename} из {zip_path}.")
+                logging.error("Попробуйте использовать чтение по частям (chunking) или увеличьте доступную память.")
+                return None
+            except Exception as e:
+                logging.error(f"Неожиданная ошибка при обработке {zip_path}/{csv_filename}: {e}")
+                continue
+
+            if df is None:
+                continue
+
+            if first_file_columns is None:
+                first_file_columns = df.columns
+            elif not df.columns.equals(first_file_columns):
+                logging.warning(f"Набор колонок в {csv_filename} отличается от первого файла!")
+
+            dataframes.append(df)
+        # Future хранит результат: очищаем список, чтобы исходные DataFrame'ы держал только dataframes
+        futures.clear()
+    finally:
+        # Без ожидания: при ошибке (например, MemoryError) не ждем окончания остальных многогигабайтных чтений
+        executor.shutdown(wait=False, cancel_futures=True)
 
     if not dataframes:
         logging.error("Не удалось загрузить ни одного DataFrame. Объединение невозможно.")
@@ -83,11 +193,8 @@ def read_combine_from_zips(zip_files: List[str],
 
     try:
         logging.info(f"Объединение {len(dataframes)} DataFrame'ов...")
-        combined_df = pd.concat(dataframes, ignore_index=True)
+        combined_df = concat_dataframes(dataframes)
         logging.info(f"DataFrame'ы успешно объединены. Итоговая форма: {combined_df.shape}")
-        del dataframes
-        import gc
-        gc.collect()
         return combined_df
     except MemoryError:
         logging.error("Ошибка нехватки памяти при объединении DataFrame'ов.")
@@ -96,10 +203,101 @@ def read_combine_from_zips(zip_files: List[str],
         logging.error(f"Неожиданная ошибка при объединении DataFrame'ов: {e}")
         return None
 
+def stream_combine_to_csv(zip_files: List[str],
+                          csv_names: List[str],
+                          source_dir: Path,
+                          output_dir: Path,
+                          filename: str) -> bool:
+    """
+    Склеивает CSV файлы из zip-архивов в один CSV потоком, не загружая данные в память.
+
+    Заголовок берется из первого файла; у остальных он пропускается. Потоковое объединение
+    возможно только при одинаковых заголовках, иначе следует использовать read_combine_from_zips.
+
+    Результат не совпадает побайтно с выгрузкой через pandas: значения копируются как есть
+    (например, code_postal "51200"), тогда как save_dataframe_to_csv пишет числовые колонки
+    с пропусками в формате float ("51200.0"). Запросы, сравнивающие такие колонки как текст,
+    нужно согласовать с выбранным режимом.
+
+    Args:
+        zip_files: Список имен zip-файлов для обработки.
+        csv_names: Список ожидаемых имен CSV-файлов внутри соответствующих zip-архивов.
+        source_dir: Путь к директории с zip-архивами.
+        output_dir: Директория для сохранения файла.
+        filename: Имя выходного CSV файла.
+
+    Returns:
+        True в случае успеха, иначе False.
+    """
+    if len(zip_files) != len(csv_names):
+        logging.error("Количество zip-файлов и ожидаемых имен CSV должно совпадать.")
+        return False
+
+    try:
+        output_dir.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        logging.error(f"Не удалось создать директорию {output_dir}: {e}")
+        return False
+
+    output_path = output_dir / filename
+    logging.info(f"Потоковое объединение CSV файлов из архивов в {output_path}...")
+    header = None
+
+    try:
+        with open(output_path, 'w+b') as out_file:
+            for zip_filename, csv_filename in zip(zip_files, csv_names):
+                zip_path = source_dir / zip_filename
+                if not zip_path.is_file():
+                    logging.warning(f"Файл архива не найден: {zip_path}. Пропуск.")
+                    continue
+
+                try:
+                    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                        if csv_filename not in zip_ref.namelist():
+                            logging.warning(f"Файл {csv_filename} не найден внутри архива {zip_path}. Пропуск.")
+                            continue
+
+                        with zip_ref.open(csv_filename, 'r') as csv_file:
+                            file_header = csv_file.readline()
+                            if not file_header:
+                                logging.warning(f"Файл {csv_filename} в архиве {zip_path} пуст. Пропуск.")
+                                continue
+                            if header is None:
+                                header = file_header
+                                out_file.write(header)
+                            elif file_header != header:
+                                logging.error(f"Набор колонок в {csv_filename} отличается от первого файла! "
+                                              "Потоковое объединение невозможно.")
+                                return False
+
+                            shutil.copyfileobj(csv_file, out_file, STREAM_COPY_CHUNK_SIZE)
+                            # Последняя строка файла может быть без перевода строки - не склеиваем ее со следующим файлом
+                            out_file.seek(-1, io.SEEK_CUR)
+                            if out_file.read(1) != b'\n':
+                                out_file.write(b'\n')
+                    logging.info(f"Добавлен {csv_filename} из {zip_path}.")
+
+                except zipfile.BadZipFile:
+                    logging.error(f"Ошибка: Файл {zip_path} не является zip-архивом или поврежден.")
+    except OSError as e:
+        logging.error(f"Ошибка записи файла {output_path}: {e}")
+        return False
+
+    if header is None:
+        logging.error("Не удалось прочитать ни одного CSV файла. Объединение невозможно.")
+        return False
+
+    logging.info(f"CSV файлы успешно объединены в {output_path}")
+    return True
+
 def analyze_dataframe(df: pd.DataFrame, df_name: str = "Объединенный датасет") -> None:
     """
     Выполняет и выводит первичный анализ pandas DataFrame.
-    (Остается без изменений от предыдущей версии)
+
+    Статистики собираются в одном цикле по колонкам (для каждой колонки отдельно считаются
+    пропуски, уникальные значения, память и describe/value_counts), после чего из них
+    формируются все разделы отчета. Вместо df.info() выводится таблица с типом,
+    числом непустых значений и памятью по каждой колонке.
     """
     if df is None or df.empty:
         logging.warning(f"DataFrame '{df_name}' пуст или отсутствует. Анализ невозможен.")
@@ -125,18 +323,51 @@ def analyze_dataframe(df: pd.DataFrame, df_name: str = "Объединенный
             logging.info(f"  - {col}")
 
 
+    # Метрики считаются в одном цикле по колонкам (колонка обрабатывается целиком, пока она
+    # в кэше); разделы ниже формируются из собранной статистики без повторного обращения к df
+    column_stats = {}
+    for col in df.columns:
+        series = df[col]
+        null_count = int(series.isna().sum())
+        is_numeric = is_numeric_dtype(series) and not is_bool_dtype(series)
+        if is_numeric:
+            unique_count = series.nunique(dropna=True)
+            description = series.describe()
+        else:
+            value_counts = series.value_counts(dropna=True)
+            unique_count = len(value_counts)
+            description = pd.Series({
+                "count": len(series) - null_count,
+                "unique": unique_count,
+                "top": value_counts.index[0] if unique_count else None,
+                "freq": value_counts.iloc[0] if unique_count else None,
+            })
+        column_stats[col] = {
+            "dtype": series.dtype,
+            "non_null": len(series) - null_count,
+            "nulls": null_count,
+            "unique": unique_count,
+            "memory": series.memory_usage(index=False, deep=True),
+            "numeric": is_numeric,
+            "describe": description,
+        }
+
     # 3. Информация о типах данных и памяти
-    buffer = io.StringIO()
-    df.info(verbose=True, memory_usage='deep', buf=buffer)
-    info_output = buffer.getvalue()
-    logging.info("Информация о типах данных и использовании памяти:\n" + info_output)
+    info_table = pd.DataFrame({
+        "Dtype": {col: str(st["dtype"]) for col, st in column_stats.items()},
+        "Non-Null Count": {col: st["non_null"] for col, st in column_stats.items()},
+        "Memory (bytes)": {col: st["memory"] for col, st in column_stats.items()},
+    })
+    total_memory_mb = (info_table["Memory (bytes)"].sum() + df.index.memory_usage(deep=True)) / 1024 ** 2
+    logging.info("Информация о типах данных и использовании памяти:\n" + info_table.to_string()
+                 + f"\nmemory usage: {total_memory_mb:.1f} MB")
 
     # 4. Процент пропущенных значений
     logging.info("Процент пропущенных значений по колонкам (топ 20 с пропусками):")
-    missing_percentage = (df.isnull().sum() * 100 / len(df)).sort_values(ascending=False)
+    missing_percentage = pd.Series({col: st["nulls"] for col, st in column_stats.items()}, dtype=float) * 100 / len(df)
     missing_info = missing_percentage[missing_percentage > 0]
     if not missing_info.empty:
-        logging.info("\n" + missing_info.head(20).to_string()) # Показываем топ 20
+        logging.info("\n" + missing_info.nlargest(20).to_string()) # Показываем топ 20
         if len(missing_info) > 20:
             logging.info(f"... и еще {len(missing_info) - 20} колонок с пропусками.")
     else:
@@ -144,28 +375,26 @@ def analyze_dataframe(df: pd.DataFrame, df_name: str = "Объединенный
 
     # 5. Описательные статистики для числовых колонок
     logging.info("Описательные статистики для числовых колонок:")
-    try:
-        numeric_desc = df.describe(include='number').round(2)
-        logging.info("\n" + numeric_desc.to_string())
-    except ValueError:
-         logging.info("Числовые колонки не найдены.")
+    numeric_desc = {col: st["describe"] for col, st in column_stats.items() if st["numeric"]}
+    if numeric_desc:
+        logging.info("\n" + pd.DataFrame(numeric_desc).round(2).to_string())
+    else:
+        logging.info("Числовые колонки не найдены.")
 
 
     # 6. Описательные статистики для нечисловых (object/category) колонок
     logging.info("Описательные статистики для нечисловых (object/categorical) колонок:")
-    try:
-        object_desc = df.describe(exclude='number')
-        logging.info("\n" + object_desc.to_string())
-    except ValueError:
+    object_desc = {col: st["describe"] for col, st in column_stats.items() if not st["numeric"]}
+    if object_desc:
+        logging.info("\n" + pd.DataFrame(object_desc).to_string())
+    else:
         logging.info("Нечисловые колонки для описательной статистики не найдены.")
-    except Exception as e:
-         logging.error(f"Ошибка при расчете статистик для нечисловых колонок: {e}")
 
 
     # 7. Количество уникальных значений (топ 20 по убыванию уникальности)
     logging.info("Количество уникальных значений по колонкам (топ 20):")
-    unique_counts = df.nunique().sort_values(ascending=False)
-    logging.info("\n" + unique_counts.head(20).to_string())
+    unique_counts = pd.Series({col: st["unique"] for col, st in column_stats.items()})
+    logging.info("\n" + unique_counts.nlargest(20).to_string())
     if len(unique_counts) > 20:
         logging.info(f"... и еще {len(unique_counts) - 20} колонок.")
 
@@ -199,7 +428,7 @@ def save_dataframe_to_csv(df: pd.DataFrame, output_dir: Path, filename: str) ->
     logging.info(f"Начало сохранения DataFrame в файл: {output_path}...")
 
     try:
-        df.to_csv(output_path, index=False, encoding='utf-8')
+        df.to_csv(output_path, index=False, encoding='utf-8', chunksize=CSV_WRITE_CHUNK_ROWS)
         logging.info(f"DataFrame успешно сохранен в {output_path}")
         return True
     except MemoryError:
@@ -220,6 +449,17 @@ if __name__ == "__main__":
         logging.error(f"Директория с исходными zip-файлами не найдена: {SOURCE_ZIP_DIR}")
         exit(1)
 
+    if not ANALYZE_COMBINED:
+        # Только объединение и сохранение: потоком из архивов в итоговый CSV
+        logging.warning("Потоковый режим: числовые значения сохраняются как в исходных файлах "
+                        "(code_postal '51200', а не '51200.0', как при выгрузке через pandas).")
+        if not stream_combine_to_csv(ZIP_FILENAMES, EXPECTED_CSV_NAMES, SOURCE_ZIP_DIR,
+                                     OUTPUT_DIR, OUTPUT_CSV_FILENAME):
+            logging.error("Не удалось сохранить итоговый CSV файл.")
+            exit(1)
+        logging.info("Скрипт успешно завершил работу.")
+        exit(0)
+
     # Шаг 1: Чтение из архивов и объединение
     combined_dataframe = read_combine_from_zips(ZIP_FILENAMES, EXPECTED_CSV_NAMES, SOURCE_ZIP_DIR)
 